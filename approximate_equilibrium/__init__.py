@@ -1,7 +1,45 @@
+import importlib
 
-from approximate_equilibrium.model import scale, model_fit, plot_capacity_vs_revenue, plot_revenue_per_capacity, save_models
-from approximate_equilibrium.model_icnn import icnn_model, model_icnn, plot_loss, calculate_mse_error, plot_errors
-from approximate_equilibrium.optimize import objective_function, de_optimizer, brute_force_optimizer, objective_function_iccn, gradient_optimizer
-from approximate_equilibrium.datadir import DataDir
-from approximate_equilibrium.datastruct import DataStruct, DataAggregator
-from approximate_equilibrium.diagonalization import DiagonalizedSolver
+# Public names and the submodules defining them. Submodules are imported on
+# first attribute access, so that e.g. the solver can be imported without
+# pulling in Keras/TensorFlow, matplotlib or seaborn.
+_EXPORTS = {
+    "approximate_equilibrium.model": ["scale", "model_fit", "plot_capacity_vs_revenue",
+                                      "plot_revenue_per_capacity", "save_models",
+                                      "load_models", "fit_models", "halving_search"],
+    "approximate_equilibrium.model_icnn": ["icnn_model", "model_icnn", "plot_loss",
+                                           "calculate_mse_error", "plot_errors",
+                                           "save_training_arrays", "compare_icnn_training"],
+    "approximate_equilibrium.optimize": ["objective_function", "objective_function_batch",
+                                         "de_optimizer", "brute_force_optimizer", "grid_optimizer",
+                                         "objective_function_iccn", "gradient_optimizer",
+                                         "PredictionCache", "ICNNEvaluator", "NumpyICNN",
+                                         "NumpyICNNEvaluator", "icnn_parity", "clear_evaluators",
+                                         "CompiledTreeEnsemble"],
+    "approximate_equilibrium.datadir": ["DataDir"],
+    "approximate_equilibrium.datastruct": ["DataStruct", "DataAggregator"],
+    "approximate_equilibrium.diagonalization": ["DiagonalizedSolver"],
+    "approximate_equilibrium.sampling": ["propose_samples", "propose_from_solver",
+                                         "export_configurations", "solver_trajectory"],
+    "approximate_equilibrium.modelbank": ["ModelBank", "save_model_bank"],
+    "approximate_equilibrium.sweep": ["ScenarioSweep", "AdjustedModels"],
+    "approximate_equilibrium.instrument": ["log_to_console"],
+    "approximate_equilibrium.acceleration": ["PlainUpdate", "DampedUpdate", "AdaptiveDampedUpdate",
+                                             "AndersonUpdate", "update_scheme"],
+}
+
+_MODULE_OF = {name: module for module, names in _EXPORTS.items() for name in names}
+
+__all__ = list(_MODULE_OF)
+
+
+def __getattr__(name):
+    if name not in _MODULE_OF:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module(_MODULE_OF[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,140 @@
+import numpy as np
+
+
+class PlainUpdate(object):
+    """Next X is the round's best responses G (the plain fixed-point iteration)"""
+
+    def reset(self):
+        pass
+
+    def get_state(self):
+        """The scheme's history as a dict of arrays, for checkpoints"""
+        return {}
+
+    def set_state(self, state):
+        pass
+
+    def __call__(self, X, G):
+        return G
+
+
+class DampedUpdate(PlainUpdate):
+    """Next X is X + beta (G - X) for a fixed beta in (0, 1]"""
+
+    def __init__(self, beta=0.5):
+        self.beta = beta
+
+    def __call__(self, X, G):
+        return X + self.beta * (G - X)
+
+
+def _last(value):
+    return np.array(np.nan if value is None else value)
+
+
+def _restore_last(array):
+    value = float(array)
+    return None if np.isnan(value) else value
+
+
+class AdaptiveDampedUpdate(PlainUpdate):
+    """
+    Damped update whose beta grows by `grow` (up to 1) after a round that
+    reduced the residual norm |G - X| and shrinks by `shrink` (down to
+    beta_min) after one that did not
+    """
+
+    def __init__(self, beta=0.5, grow=1.2, shrink=0.5, beta_min=0.05):
+        self.beta0 = beta
+        self.grow = grow
+        self.shrink = shrink
+        self.beta_min = beta_min
+        self.reset()
+
+    def reset(self):
+        self.beta = self.beta0
+        self._last = None
+
+    def get_state(self):
+        return {"beta": np.array(self.beta), "last": _last(self._last)}
+
+    def set_state(self, state):
+        if not state:
+            return
+        self.beta = float(state["beta"])
+        self._last = _restore_last(state["last"])
+
+    def __call__(self, X, G):
+        residual = np.linalg.norm(G - X)
+        if self._last is not None:
+            if residual < self._last:
+                self.beta = min(1., self.beta * self.grow)
+            else:
+                self.beta = max(self.beta_min, self.beta * self.shrink)
+        self._last = residual
+        return X + self.beta * (G - X)
+
+
+class AndersonUpdate(PlainUpdate):
+    """
+    Anderson acceleration (type II) over the last `window` rounds: the next
+    X mixes the recent best responses with the weights that minimise the
+    norm of the combined residual G - X, with relaxation beta and a small
+    Tikhonov term `reg` on the least-squares problem. When a round's
+    residual norm is larger than the previous round's, the history is
+    dropped and a plain relaxed step is taken instead.
+    """
+
+    def __init__(self, window=5, beta=1., reg=1e-10):
+        self.window = window
+        self.beta = beta
+        self.reg = reg
+        self.reset()
+
+    def reset(self):
+        self._x = []
+        self._f = []
+        self._last = None
+
+    def get_state(self):
+        return {"x": np.array(self._x), "f": np.array(self._f), "last": _last(self._last)}
+
+    def set_state(self, state):
+        if not state:
+            return
+        self._x = list(state["x"])
+        self._f = list(state["f"])
+        self._last = _restore_last(state["last"])
+
+    def __call__(self, X, G):
+        x, f = X.ravel(), (G - X).ravel()
+        residual = np.linalg.norm(f)
+        if self._last is not None and residual > self._last:
+            self._x, self._f = [], []
+        self._last = residual
+        self._x.append(x)
+        self._f.append(f)
+        del self._x[:-(self.window + 1)], self._f[:-(self.window + 1)]
+        if len(self._f) < 2:
+            return X + self.beta * (G - X)
+        dX = np.diff(np.array(self._x), axis=0).T
+        dF = np.diff(np.array(self._f), axis=0).T
+        A = dF.T @ dF
+        A += self.reg * max(np.trace(A), 1.) * np.eye(A.shape[0])
+        gamma = np.linalg.solve(A, dF.T @ f)
+        x_new = x + self.beta * f - (dX + self.beta * dF) @ gamma
+        if not np.all(np.isfinite(x_new)):
+            self.reset()
+            return G
+        return x_new.reshape(X.shape)
+
+
+SCHEMES = {"plain": PlainUpdate, "damping": DampedUpdate, "adaptive": AdaptiveDampedUpdate,
+           "anderson": AndersonUpdate}
+
+
+def update_scheme(name, **options):
+    """Update scheme `name` (see SCHEMES) built with the given options"""
+    if name not in SCHEMES:
+        raise ValueError("unknown update scheme: {}".format(name))
+    return SCHEMES[name](**options)
@@ -0,0 +1,312 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+
+# Modules the solver path must not import
+HEAVY_MODULES = ("tensorflow", "keras", "matplotlib", "seaborn", "sklearn")
+
+_IMPORT_SCRIPT = """
+import json, sys, time
+tic = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - tic
+heavy = sorted(m for m in {heavy!r} if m in sys.modules)
+print(json.dumps({{"seconds": elapsed, "heavy_modules": heavy}}))
+"""
+
+
+def import_time(module="approximate_equilibrium.diagonalization", repeat=3):
+    """
+    Wall time of importing `module` in a fresh interpreter (best of `repeat`)
+    and the heavy modules that import pulled in
+    """
+    script = _IMPORT_SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", script], check=True,
+                             stdout=subprocess.PIPE, universal_newlines=True).stdout
+        runs.append(json.loads(out.strip().splitlines()[-1]))
+    best = min(runs, key=lambda r: r["seconds"])
+    return {"module": module, "seconds": best["seconds"], "heavy_modules": best["heavy_modules"]}
+
+
+def check_import_budget(budget=2., modules=("approximate_equilibrium.diagonalization",
+                                            "approximate_equilibrium.optimize.optimization"),
+                        repeat=3):
+    """
+    Time a solver-only import of each of `modules` and raise a RuntimeError
+    if one takes longer than `budget` seconds or imports any of HEAVY_MODULES
+    """
+    results = [import_time(m, repeat) for m in modules]
+    for r in results:
+        print("{}: {:1.3f}s".format(r["module"], r["seconds"]))
+    failed = [r for r in results if r["seconds"] > budget or r["heavy_modules"]]
+    if failed:
+        raise RuntimeError("solver import over budget ({:1.2f}s) or importing heavy modules: {}".format(
+            budget, ", ".join("{} ({:1.3f}s, {})".format(r["module"], r["seconds"], r["heavy_modules"])
+                              for r in failed)))
+    return results
+
+
+# Technologies of the synthetic market: base revenue per MW and capital cost per MW
+SYNTHETIC_DEVICES = {"CT": (60., 35.), "CC": (70., 45.), "ST": (65., 50.), "WT": (55., 30.),
+                     "PVe": (50., 25.), "BA": (45., 30.), "HY": (80., 60.)}
+
+
+def _market(capacity, hours, rng):
+    """Hourly prices and dispatch of a toy market where prices fall as capacity is added"""
+    base = np.array([v[0] for v in SYNTHETIC_DEVICES.values()])[:capacity.shape[-1]]
+    load = capacity.sum() * (0.4 + 0.3 * np.sin(np.linspace(0, 2*np.pi, hours)))
+    price = base.mean() * np.exp(-capacity.sum() / (capacity.size * 1000.)) * (1. + 0.2 * rng.rand(hours))
+    share = capacity * base / max((capacity * base).sum(), 1e-9)
+    dispatch = np.minimum(load[:, None] * share[None, :], capacity[None, :])
+    return price, dispatch
+
+
+def make_synthetic_samples(root, num_samples=50, num_devices=7, hours=24, max_capacity=1000.,
+                           output_dir="output", seed=0):
+    """
+    Write a synthetic sample tree under root in both layouts read by the
+    package: DataDir.populate_rts / DataAggregator (sample_configuration_R1/
+    sample_R<n>/1/results/training_data.csv with Category, Capacity and
+    Revenue) and DataDir.populate / DataStruct (<output_dir>/<n>/ with
+    dispatch.csv, energyprices.csv and generators.csv). Returns the device
+    names and the per-device variable costs.
+    """
+    rng = np.random.RandomState(seed)
+    devices = list(SYNTHETIC_DEVICES)[:num_devices]
+    variable_cost = {d: float(5. + 5. * k) for k, d in enumerate(devices)}
+    vc = np.array([variable_cost[d] for d in devices])
+    for n in range(num_samples):
+        capacity = rng.rand(len(devices)) * max_capacity
+        price, dispatch = _market(capacity, hours, rng)
+        revenue = price @ dispatch - dispatch.sum(axis=0) * vc
+
+        results = os.path.join(root, "sample_configuration_R1", "sample_R{}".format(n), "1", "results")
+        os.makedirs(results, exist_ok=True)
+        pd.DataFrame({"Category": devices, "Capacity": capacity, "Revenue": revenue}).to_csv(
+            os.path.join(results, "training_data.csv"), index=False)
+
+        sample = os.path.join(root, output_dir, str(n))
+        os.makedirs(sample, exist_ok=True)
+        pd.DataFrame(dispatch, columns=devices).to_csv(os.path.join(sample, "dispatch.csv"))
+        pd.DataFrame({"price": price}).to_csv(os.path.join(sample, "energyprices.csv"))
+        pd.DataFrame({"capacity": capacity}, index=devices).to_csv(os.path.join(sample, "generators.csv"))
+    return devices, variable_cost
+
+
+def train_xgboost(capacity, revenue, n_estimators=50, max_depth=4):
+    """Small per-technology XGBRegressor surrogates"""
+    from xgboost import XGBRegressor
+    models = []
+    for ix in range(revenue.shape[1]):
+        model = XGBRegressor(objective="reg:squarederror", booster="gbtree",
+                             max_depth=max_depth, n_estimators=n_estimators, learning_rate=0.1)
+        model.fit(capacity, revenue[:, ix])
+        models.append(model)
+    return models
+
+
+def train_icnn(capacity, revenue, num_layers=1, num_units=16, epochs=5):
+    """Small per-technology ICNN surrogates (see model_icnn.icnn_model)"""
+    from approximate_equilibrium.model_icnn import icnn_model
+    models = []
+    for ix in range(revenue.shape[1]):
+        model = icnn_model(capacity.shape[1], 1, num_layers=num_layers, num_units=num_units)
+        model.compile(optimizer="adam", loss="mean_squared_error")
+        model.fit(capacity, revenue[:, ix], epochs=epochs, verbose=0)
+        models.append(model)
+    return models
+
+
+def _rate(func, min_time=0.5):
+    """Calls of func per second, over at least min_time seconds"""
+    func()
+    calls, tic = 0, time.perf_counter()
+    while True:
+        func()
+        calls += 1
+        elapsed = time.perf_counter() - tic
+        if elapsed >= min_time:
+            return calls / elapsed
+
+
+def _timed(func, repeat):
+    """Mean wall time of func over repeat calls, its printed output discarded"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        tic = time.perf_counter()
+        for _ in range(repeat):
+            func()
+    return (time.perf_counter() - tic) / repeat
+
+
+def _megabytes(paths):
+    return sum(os.path.getsize(p) for p in paths) / 2**20
+
+
+def bench_ingest(root, devices, variable_cost, n_jobs=4, output_dir="output"):
+    """MB/s of the DataAggregator and DataStruct ingest paths over a sample tree"""
+    from approximate_equilibrium.datadir import DataDir
+    from approximate_equilibrium.datastruct import DataStruct, DataAggregator
+    datadir = DataDir(root, output_dir)
+    datadir.populate()
+    datadir.populate_rts()
+    results = {}
+
+    agg = DataAggregator(None)
+    agg.path_array = datadir.training_files
+    mb = _megabytes(agg.path_array)
+    results["aggregator_read_capacity_revenue"] = mb / _timed(lambda: (agg.read_capacity(), agg.read_revenue()), 1)
+    results["aggregator_read_data"] = mb / _timed(lambda: agg.read_data(n_jobs=n_jobs), 1)
+
+    D = DataStruct()
+    D.add_info(devices, datadir, variable_cost)
+    mb = _megabytes(datadir.dispatch_files + datadir.price_files)
+    results["datastruct_read_revenue"] = mb / _timed(
+        lambda: (D.read_prices(), D.read_dispatch(), D.calculate_revenue()), 1)
+    results["datastruct_stream_revenue"] = mb / _timed(lambda: D.stream_revenue(n_jobs=n_jobs), 1)
+    return {"MB/s": results}
+
+
+def _problem(capacity, num_agents, seed=0):
+    """Nodes, capital costs, capacity limits and a starting X for a synthetic solve"""
+    rng = np.random.RandomState(seed)
+    num_gens = capacity.shape[1]
+    cost = np.array([v[1] for v in SYNTHETIC_DEVICES.values()])[:num_gens]
+    capcosts = cost[None, :] * (0.8 + 0.4 * rng.rand(num_agents, num_gens))
+    caplimits = np.full((num_agents, num_gens), capacity.max())
+    X = rng.rand(num_agents, num_gens) * capacity.max() / (2. * num_agents)
+    return list(capacity), capcosts, caplimits, X
+
+
+def bench_objective(models, capacity, num_agents=3, batch_size=1000, min_time=0.5):
+    """Objective evaluations per second, one point at a time and in populations"""
+    from approximate_equilibrium.optimize import objective_function, objective_function_batch
+    _, capcosts, _, X = _problem(capacity, num_agents)
+    x_ineg = X[1:].sum(axis=0)
+    x_i = X[0]
+    pop = np.random.RandomState(1).rand(batch_size, X.shape[1]) * capacity.max()
+    single = _rate(lambda: objective_function(x_i, x_i, x_ineg, capcosts[0], models), min_time)
+    batch = _rate(lambda: objective_function_batch(pop, x_i, x_ineg, capcosts[0], models), min_time)
+    return {"single": single, "batch": batch * batch_size}
+
+
+def bench_icnn_objective(models, capacity, num_agents=3, min_time=0.5):
+    """Value-and-gradient evaluations per second of objective_function_iccn"""
+    from approximate_equilibrium.optimize import objective_function_iccn, icnn_evaluator
+    _, capcosts, _, X = _problem(capacity / capacity.max(), num_agents)
+    evaluator = icnn_evaluator(models)
+    x_ineg = X[1:].sum(axis=0)
+    return {"value_and_gradient": _rate(
+        lambda: objective_function_iccn(X[0], x_ineg, capcosts[0], None, evaluator), min_time)}
+
+
+def bench_solver(models, capacity, datastruct=None, num_agents=3, rounds=1, num_x0=1, seed=0):
+    """Seconds per de_optimizer agent solve and per DiagonalizedSolver round"""
+    from approximate_equilibrium.optimize import de_optimizer
+    from approximate_equilibrium.diagonalization import DiagonalizedSolver
+    nodes, capcosts, caplimits, X = _problem(capacity, num_agents, seed)
+    agent = _timed(lambda: de_optimizer(X, 0, nodes, capcosts[0], caplimits[0], datastruct, models, 1,
+                                        num_x0=num_x0, seed=seed), 1)
+    solver = DiagonalizedSolver(capcosts, caplimits, nodes, models, list(range(capacity.shape[1])),
+                                datastruct, seed=seed)
+    solver.set_starting_cap(X.copy())
+    solver.set_restart_options(1)
+    round_s = _timed(solver.step, rounds)
+    return {"agent_solve_s": agent, "round_s": round_s}
+
+
+def bench_icnn_training(agg, epochs=2, batch_size=32):
+    """
+    Short run of model_icnn.compare_icnn_training (per-technology and
+    multi-output ICNNs, trained from memory-mapped arrays) on the data of a
+    DataAggregator: test RMSE per technology and training throughput
+    """
+    from approximate_equilibrium.datastruct import DataStruct
+    from approximate_equilibrium.model_icnn import compare_icnn_training, save_training_arrays
+    D = DataStruct()
+    D.read_aggregated_data(agg)
+    D.tranform_data()
+    with tempfile.TemporaryDirectory() as tmp:
+        save_training_arrays(D, tmp)
+        errors, throughput = compare_icnn_training(D, data_dir=tmp, batch_size=batch_size, epochs=epochs)
+    return {"rmse": {k: [float(e) for e in v] for k, v in errors.items()}, "throughput": throughput}
+
+
+def run_suite(num_samples=200, num_devices=7, hours=24, num_agents=3, rounds=1, n_jobs=4,
+              icnn=True, out_file=None, root=None, seed=0):
+    """
+    Generate a synthetic sample tree, train small surrogates on it and time
+    the solver and ingest hot paths. The results (with the run settings)
+    are returned as a dict and, with out_file, written to it as JSON.
+    """
+    settings = dict(num_samples=num_samples, num_devices=num_devices, hours=hours,
+                    num_agents=num_agents, rounds=rounds, n_jobs=n_jobs, seed=seed)
+    results = {"settings": settings, "python": sys.version.split()[0],
+               "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    with tempfile.TemporaryDirectory() as tmp:
+        root = root or tmp
+        devices, variable_cost = make_synthetic_samples(root, num_samples, num_devices, hours, seed=seed)
+        results["ingest"] = bench_ingest(root, devices, variable_cost, n_jobs)
+
+        from approximate_equilibrium.datadir import DataDir
+        from approximate_equilibrium.datastruct import DataAggregator
+        datadir = DataDir(root, "output")
+        datadir.populate_rts()
+        agg = DataAggregator(None)
+        agg.path_array = datadir.training_files
+        agg.read_data()
+        capacity, revenue = agg.capacity.values, agg.revenue.values
+
+    xgb = train_xgboost(capacity, revenue)
+    results["xgboost"] = {"objective_evals_per_s": bench_objective(xgb, capacity, num_agents)}
+    from approximate_equilibrium.modelbank import benchmark_load
+    with tempfile.TemporaryDirectory() as tmp:
+        results["xgboost"]["model_load"] = benchmark_load(xgb, devices, tmp)
+    results["xgboost"].update(bench_solver(xgb, capacity, num_agents=num_agents, rounds=rounds, seed=seed))
+
+    if icnn:
+        try:
+            scaled = capacity / capacity.max()
+            nets = train_icnn(scaled.astype("float32"), 1. - revenue / revenue.max())
+        except ImportError as e:
+            results["icnn"] = {"skipped": str(e)}
+        else:
+            results["icnn"] = {"objective_evals_per_s": bench_icnn_objective(nets, capacity, num_agents)}
+            results["icnn"]["training"] = bench_icnn_training(agg)
+
+    if out_file is not None:
+        with open(out_file, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="approximate_equilibrium benchmarks")
+    parser.add_argument("--imports", action="store_true", help="only check the solver import budget")
+    parser.add_argument("--samples", type=int, default=200)
+    parser.add_argument("--devices", type=int, default=7)
+    parser.add_argument("--hours", type=int, default=24)
+    parser.add_argument("--agents", type=int, default=3)
+    parser.add_argument("--rounds", type=int, default=1)
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--no-icnn", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="JSON file for the results")
+    args = parser.parse_args()
+    if args.imports:
+        check_import_budget()
+    else:
+        res = run_suite(args.samples, args.devices, args.hours, args.agents, args.rounds, args.jobs,
+                        icnn=not args.no_icnn, out_file=args.out, seed=args.seed)
+        print(json.dumps(res, indent=2))
@@ -0,0 +1,170 @@
+import os
+from collections.abc import Sequence
+
+import numpy as np
+
+
+def atomic_savez(path, **arrays):
+    """np.savez to a temporary file next to `path`, then rename it into place"""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class HistoryLog(object):
+    """
+    Append-only binary log of the agents' decisions. Each solve is one
+    float64 record (round, agent, f, x_1, ..., x_num_gens); records are
+    buffered and appended to the file by flush(), or once buffer_size of
+    them are pending. Each agent's last record and the positions of its
+    records are kept in memory, so the latest decision and the history
+    length cost O(1); the full history is read back through a memory map.
+    """
+
+    def __init__(self, path, num_gens, buffer_size=1000):
+        self.path = path
+        self.num_gens = num_gens
+        self.buffer_size = buffer_size
+        self._pending = []
+        if not os.path.exists(path):
+            open(path, "wb").close()
+        self._reindex()
+
+    @property
+    def record_size(self):
+        return (3 + self.num_gens) * 8
+
+    def __len__(self):
+        return self._num_stored + len(self._pending)
+
+    def _stored(self):
+        """Memory map of the records in the file"""
+        if self._map is None and self._num_stored > 0:
+            self._map = np.memmap(self.path, dtype=np.float64, mode="r",
+                                  shape=(self._num_stored, 3 + self.num_gens))
+        return self._map
+
+    def _reindex(self):
+        """Rebuild the per-agent positions and last records from the file"""
+        self._num_stored = os.path.getsize(self.path) // self.record_size
+        self._map = None
+        self._positions = {}
+        self._last = {}
+        if self._num_stored:
+            stored = self._stored()
+            agents = np.asarray(stored[:, 1]).astype(int)
+            for agent in np.unique(agents):
+                pos = np.flatnonzero(agents == agent)
+                self._positions[int(agent)] = pos.tolist()
+                self._last[int(agent)] = np.array(stored[pos[-1]])
+
+    def append(self, round, agent, x, f):
+        rec = np.empty(3 + self.num_gens)
+        rec[:3] = round, agent, f
+        rec[3:] = np.asarray(x, dtype=float).reshape(-1)
+        self._positions.setdefault(int(agent), []).append(len(self))
+        self._last[int(agent)] = rec
+        self._pending.append(rec)
+        if len(self._pending) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        with open(self.path, "ab") as f:
+            f.write(np.vstack(self._pending).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        self._num_stored += len(self._pending)
+        self._map = None
+        self._pending = []
+
+    def truncate(self, num_records):
+        """Drop everything after the first num_records records"""
+        self._pending = []
+        self._map = None
+        with open(self.path, "r+b") as f:
+            f.truncate(num_records * self.record_size)
+        self._reindex()
+
+    def records(self):
+        """All records as a (num_records, 3 + num_gens) array"""
+        stored = self._stored()
+        if stored is None:
+            stored = np.empty((0, 3 + self.num_gens))
+        if self._pending:
+            return np.vstack([stored, np.vstack(self._pending)])
+        return stored
+
+    def count(self, agent):
+        return len(self._positions.get(agent, ()))
+
+    def last(self, agent):
+        return self._last[agent]
+
+    def record(self, agent, ix):
+        """Record number ix (negative counts from the end) of agent"""
+        pos = self._positions.get(agent, [])[ix]
+        if pos >= self._num_stored:
+            return self._pending[pos - self._num_stored]
+        return np.array(self._stored()[pos])
+
+    def agent_records(self, agent):
+        """All records of agent, read from the memory map at their known positions"""
+        pos = np.asarray(self._positions.get(agent, []), dtype=np.intp)
+        stored = pos[pos < self._num_stored]
+        recs = [np.asarray(self._stored()[stored])] if stored.size else []
+        recs += [self._pending[p - self._num_stored] for p in pos[pos >= self._num_stored]]
+        if not recs:
+            return np.empty((0, 3 + self.num_gens))
+        return np.vstack(recs)
+
+    def agent(self, i):
+        return AgentHistory(self, i)
+
+
+class _Column(Sequence):
+
+    def __init__(self, log, agent, key):
+        self.log = log
+        self.agent = agent
+        self.key = key
+
+    def _value(self, rec):
+        return rec[2] if self.key == "f" else np.array(rec[3:])
+
+    def _values(self):
+        recs = self.log.agent_records(self.agent)
+        if self.key == "f":
+            return recs[:, 2]
+        return recs[:, 3:]
+
+    def __len__(self):
+        return self.log.count(self.agent)
+
+    def __getitem__(self, ix):
+        if isinstance(ix, slice):
+            values = self._values()[ix]
+            return np.array(values)
+        if ix == -1 or ix == len(self) - 1:
+            return self._value(self.log.last(self.agent))
+        return self._value(self.log.record(self.agent, ix))
+
+    def __iter__(self):
+        return iter(np.array(self._values()))
+
+
+class AgentHistory(object):
+    """Read-only view of one agent's "x" and "f" history in a HistoryLog"""
+
+    def __init__(self, log, agent):
+        self.log = log
+        self.agent = agent
+
+    def __getitem__(self, key):
+        if key not in ("x", "f"):
+            raise KeyError(key)
+        return _Column(self.log, self.agent, key)
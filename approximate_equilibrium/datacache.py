@@ -0,0 +1,88 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+META_FILE = "meta.json"
+CACHE_VERSION = 1
+
+
+def _files(datadir):
+    return {"dispatch": list(datadir.dispatch_files),
+            "price": list(datadir.price_files),
+            "capacity": list(datadir.capacity_files)}
+
+
+def is_fresh(datadir, devices, cache_dir):
+    """Whether cache_dir holds a cache of exactly these files and devices, newer than all of them"""
+    meta_file = os.path.join(cache_dir, META_FILE)
+    if not os.path.exists(meta_file):
+        return False
+    with open(meta_file) as f:
+        meta = json.load(f)
+    if (meta.get("version") != CACHE_VERSION or meta["files"] != _files(datadir)
+            or meta["devices"] != list(devices)):
+        return False
+    built = os.path.getmtime(meta_file)
+    return all(os.path.getmtime(p) <= built for paths in meta["files"].values() for p in paths)
+
+
+def build_cache(datadir, devices, cache_dir):
+    """
+    Convert the dispatch, price and generator CSVs of a populated DataDir
+    into dense float64 arrays in cache_dir: dispatch.npy (sample x hour x
+    device), prices.npy (hour x price column) and capacity.npy (sample x
+    device). The arrays are written through memory maps one sample at a
+    time, and meta.json is written last so an interrupted build is not
+    mistaken for a complete cache.
+    """
+    devices = list(devices)
+    os.makedirs(cache_dir, exist_ok=True)
+    meta_file = os.path.join(cache_dir, META_FILE)
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+    files = _files(datadir)
+    meta = {"version": CACHE_VERSION, "files": files, "devices": devices}
+
+    if files["capacity"]:
+        capacity = np.lib.format.open_memmap(os.path.join(cache_dir, "capacity.npy"), mode="w+",
+                                             dtype=np.float64, shape=(len(files["capacity"]), len(devices)))
+        for n, f in enumerate(files["capacity"]):
+            capacity[n] = pd.read_csv(f, index_col=0).loc[devices, "capacity"].values
+        capacity.flush()
+        del capacity
+
+    if files["price"]:
+        prices = [pd.read_csv(f, index_col=0) for f in files["price"]]
+        meta["price_index"] = prices[0].index.tolist()
+        np.save(os.path.join(cache_dir, "prices.npy"),
+                np.hstack([p.values for p in prices]).astype(np.float64))
+        del prices
+
+    if files["dispatch"]:
+        first = pd.read_csv(files["dispatch"][0], index_col=0)
+        meta["dispatch_index"] = first.index.tolist()
+        dispatch = np.lib.format.open_memmap(os.path.join(cache_dir, "dispatch.npy"), mode="w+",
+                                             dtype=np.float64,
+                                             shape=(len(files["dispatch"]), len(first), len(devices)))
+        for n, f in enumerate(files["dispatch"]):
+            df = first if n == 0 else pd.read_csv(f, index_col=0)
+            dispatch[n] = df[devices].values
+        dispatch.flush()
+        del dispatch
+
+    with open(meta_file, "w") as f:
+        json.dump(meta, f)
+
+
+def load_cache(cache_dir):
+    """Metadata and memory-mapped arrays of a cache written by build_cache"""
+    with open(os.path.join(cache_dir, META_FILE)) as f:
+        cache = json.load(f)
+    for name in ("capacity", "prices", "dispatch"):
+        path = os.path.join(cache_dir, name + ".npy")
+        if os.path.exists(path):
+            cache[name] = np.load(path, mmap_mode="r")
+    return cache
@@ -1,6 +1,48 @@
 import glob
+import json
 import os
 
+
+class SampleManifest(object):
+    """
+    Persistent JSON record of discovered result files: path -> mtime, size
+    and the number of rows parsed from it, used to tell which samples are
+    new or changed since the last ingest.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def changes(self, files):
+        """(new or changed files, files no longer present) relative to the manifest"""
+        changed = []
+        for f in files:
+            st = os.stat(f)
+            entry = self.entries.get(f)
+            if entry is None or entry["mtime"] != st.st_mtime or entry["size"] != st.st_size:
+                changed.append(f)
+        present = set(files)
+        removed = [f for f in self.entries if f not in present]
+        return changed, removed
+
+    def update(self, path, rows):
+        st = os.stat(path)
+        self.entries[path] = {"mtime": st.st_mtime, "size": st.st_size, "rows": rows}
+
+    def discard(self, path):
+        self.entries.pop(path, None)
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path)
+
+
 class DataDir(object):
 
     def __init__(self, file_path, output_dir):
@@ -12,8 +54,17 @@ class DataDir(object):
         self.price_files = glob.glob(os.path.join(self.file_path, self.output_dir+"/*/energyprices.csv"))
         self.capacity_files = glob.glob(os.path.join(self.file_path, self.output_dir+"/*/generators.csv"))
         
-    def populate_rts(self):
+    def populate_rts(self, file_name="training_data.csv"):
         self.training_files = glob.glob(os.path.join(self.file_path, 
-             "sample_configuration_R*/sample_R*/*/results/training_data.csv"))
+             "sample_configuration_R*/sample_R*/*/results/" + file_name))
+
+    def refresh_rts(self, manifest, file_name="training_data.csv"):
+        """
+        populate_rts, then compare the result files against a SampleManifest.
+        Returns the files that are new or changed since the manifest was
+        written and the ones that have disappeared.
+        """
+        self.populate_rts(file_name)
+        return manifest.changes(self.training_files)
 
 
@@ -1,6 +1,46 @@
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
 import pandas as pd
 import numpy as np
 from collections import defaultdict
+from approximate_equilibrium import datacache
+from approximate_equilibrium.datadir import SampleManifest
+
+
+def _sample_revenue(task):
+    """
+    Net revenue of every device in one sample, from its dispatch and price
+    CSVs; the prices are aligned on the dispatch file's hour index
+    """
+    dispatch_file, price_file, devices, variable_cost = task
+    dispatch = pd.read_csv(dispatch_file, index_col=0)[devices]
+    price = pd.read_csv(price_file, index_col=0).iloc[:, 0]
+    if not price.index.equals(dispatch.index):
+        if price.index.has_duplicates or not dispatch.index.isin(price.index).all():
+            raise ValueError("the hours of {} do not match those of {}".format(price_file, dispatch_file))
+        price = price.reindex(dispatch.index)
+    return price.values @ dispatch.values - dispatch.values.sum(axis=0) * variable_cost
+
+
+def _read_training_file(path, regional=False):
+    """
+    Capacity and Revenue of one training_data.csv (or reg_training_data.csv
+    with regional=True), indexed by Category (or Category_Bus). Rows
+    repeating a category are summed.
+    """
+    cols = ["Category", "Capacity", "Revenue"] + (["Bus"] if regional else [])
+    df = pd.read_csv(path, usecols=cols)
+    if regional:
+        df.index = df["Category"].astype(str).str.cat(df["Bus"].astype(str), sep="_")
+    else:
+        df.index = df["Category"]
+    df = df[["Capacity", "Revenue"]]
+    if df.index.has_duplicates:
+        df = df.groupby(level=0, sort=False).sum(min_count=1)
+    return df["Capacity"], df["Revenue"]
+
 
 class DataStruct(object):
 
@@ -12,7 +52,29 @@ class DataStruct(object):
         self.devices = devices
         self.datadir = datadir
 
+    def set_cache(self, cache_dir):
+        """
+        Read dispatch, prices and capacity from a columnar cache in
+        cache_dir (see datacache.build_cache), converting the CSVs first
+        whenever the cache is missing or older than them
+        """
+        self.cache_dir = cache_dir
+        self._cache = None
+
+    def _load_cache(self):
+        if getattr(self, "cache_dir", None) is None:
+            return None
+        if self._cache is None:
+            if not datacache.is_fresh(self.datadir, self.devices, self.cache_dir):
+                datacache.build_cache(self.datadir, self.devices, self.cache_dir)
+            self._cache = datacache.load_cache(self.cache_dir)
+        return self._cache
+
     def read_capacity(self):
+        cache = self._load_cache()
+        if cache is not None:
+            self.capacity = pd.DataFrame(np.array(cache["capacity"]), columns=list(self.devices))
+            return
         dfs = []
         for f in self.datadir.capacity_files:
             df = pd.read_csv(f, index_col=0)
@@ -21,6 +83,10 @@ class DataStruct(object):
         self.capacity.index = list(range(self.capacity.shape[0]))
 
     def read_prices(self):
+        cache = self._load_cache()
+        if cache is not None:
+            self.price = pd.DataFrame(np.array(cache["prices"]), index=cache["price_index"])
+            return
         dfs = []
         for f in self.datadir.price_files:
             dfs.append(pd.read_csv(f, index_col=0))
@@ -29,6 +95,14 @@ class DataStruct(object):
 
 
     def read_dispatch(self):
+        cache = self._load_cache()
+        if cache is not None:
+            self.dispatch = defaultdict(list)
+            for d, gen in enumerate(self.devices):
+                self.dispatch[gen] = pd.DataFrame(np.array(cache["dispatch"][:, :, d].T),
+                                                  index=cache["dispatch_index"],
+                                                  columns=[gen] * cache["dispatch"].shape[0])
+            return
         self.dispatch = defaultdict(list)
         for f in self.datadir.dispatch_files:
             df = pd.read_csv(f, index_col=0)
@@ -46,6 +120,26 @@ class DataStruct(object):
             self.revenue.append(tmp)
         self.revenue = pd.concat(self.revenue, axis=1)
 
+    def stream_revenue(self, n_jobs=1):
+        """
+        Same revenue table as read_dispatch + read_prices + calculate_revenue,
+        computed one sample at a time from the dispatch.csv / energyprices.csv
+        pair in each output directory, so only one sample's hourly data is in
+        memory per worker. With n_jobs > 1 the samples are spread over a
+        process pool.
+        """
+        devices = list(self.devices)
+        variable_cost = np.array([self.variable_cost[gen] for gen in devices], dtype=float)
+        price_files = {os.path.dirname(f): f for f in self.datadir.price_files}
+        tasks = ((f, price_files[os.path.dirname(f)], devices, variable_cost)
+                 for f in self.datadir.dispatch_files)
+        if n_jobs > 1:
+            with multiprocessing.Pool(n_jobs) as pool:
+                rows = list(pool.imap(_sample_revenue, tasks, chunksize=4))
+        else:
+            rows = [_sample_revenue(task) for task in tasks]
+        self.revenue = pd.DataFrame(np.array(rows).reshape(-1, len(devices)), columns=devices)
+
     def save_capacity(self, file_name):
         self.capacity.to_csv(file_name)
 
@@ -75,6 +169,74 @@ class DataAggregator(object):
                 currentPlace = line[:-1].replace('"', '')
                 self.path_array.append(currentPlace)
 
+    def read_data(self, regional=False, n_jobs=None, processes=False):
+        """
+        Single-pass replacement for read_capacity + read_revenue (or their
+        regional variants): every file is parsed once for both Capacity and
+        Revenue, on a thread pool (or a process pool with processes=True)
+        of n_jobs workers. Columns follow the order in which categories are
+        first seen, in every row; a category missing from a file is NaN in
+        that row.
+        """
+        parts = self._read_files(self.path_array, regional, n_jobs, processes)
+        self.capacity, self.revenue = self._stack(parts)
+
+    def _read_files(self, paths, regional, n_jobs, processes):
+        executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        with executor(max_workers=n_jobs) as pool:
+            return list(pool.map(partial(_read_training_file, regional=regional), paths))
+
+    def _stack(self, parts, columns=(), index=None):
+        columns = list(dict.fromkeys(list(columns) + [c for cap, _ in parts for c in cap.index]))
+        columns = pd.Index(columns, name="Category")
+        shape = (0, len(columns))
+        capacity = pd.DataFrame(np.vstack([cap.reindex(columns).values for cap, _ in parts] or [np.empty(shape)]),
+                                columns=columns, index=index)
+        revenue = pd.DataFrame(np.vstack([rev.reindex(columns).values for _, rev in parts] or [np.empty(shape)]),
+                               columns=columns, index=index)
+        return capacity, revenue
+
+    def refresh(self, datadir, manifest_file, regional=False, n_jobs=None, processes=False):
+        """
+        Incremental read_data over a DataDir's sample tree. Result files
+        and the aggregated tables are tracked next to manifest_file (a
+        SampleManifest, plus <manifest_file>.capacity.csv / .revenue.csv
+        indexed by file path); only files that are new or changed since the
+        last refresh are parsed, and their rows replace or extend the
+        stored tables. Returns the number of files ingested.
+        """
+        manifest = SampleManifest(manifest_file)
+        file_name = "reg_training_data.csv" if regional else "training_data.csv"
+        changed, removed = datadir.refresh_rts(manifest, file_name)
+        store = {name: "{}.{}.csv".format(manifest_file, name) for name in ("capacity", "revenue")}
+        if os.path.exists(store["capacity"]) and manifest.entries:
+            capacity = pd.read_csv(store["capacity"], index_col=0)
+            revenue = pd.read_csv(store["revenue"], index_col=0)
+        else:
+            capacity = revenue = pd.DataFrame()
+            changed = list(datadir.training_files)
+        drop = capacity.index.intersection(changed + removed)
+        capacity, revenue = capacity.drop(drop), revenue.drop(drop)
+
+        parts = self._read_files(changed, regional, n_jobs, processes)
+        new_capacity, new_revenue = self._stack(parts, capacity.columns, index=changed)
+        capacity = pd.concat([capacity, new_capacity], axis=0)
+        revenue = pd.concat([revenue, new_revenue], axis=0)
+        capacity.columns.name = revenue.columns.name = "Category"
+
+        for f in removed:
+            manifest.discard(f)
+        for f, (cap, _) in zip(changed, parts):
+            manifest.update(f, len(cap))
+        capacity.to_csv(store["capacity"])
+        revenue.to_csv(store["revenue"])
+        manifest.save()
+
+        self.path_array = list(capacity.index)
+        self.capacity = capacity.reset_index(drop=True)
+        self.revenue = revenue.reset_index(drop=True)
+        return len(changed)
+
     def read_capacity(self):
         dfs = []
         for f in self.path_array:
@@ -1,13 +1,60 @@
-import pandas as pd
+import json
+import logging
+import multiprocessing
+import os
+import time
+import math
 import numpy as np
 from collections import defaultdict
-import seaborn as sns
-from approximate_equilibrium.optimize import de_optimizer, objective_function, brute_force_optimizer, objective_function_iccn, gradient_optimizer
+from approximate_equilibrium.optimize import de_optimizer, objective_function, brute_force_optimizer, objective_function_iccn, gradient_optimizer, PredictionCache
+from approximate_equilibrium.checkpoint import HistoryLog, atomic_savez
+from approximate_equilibrium.instrument import Instrumentation, log_to_console
+from approximate_equilibrium.acceleration import update_scheme
+
+
+logger = logging.getLogger(__name__)
+
+# Per-process state of the Jacobi worker pool, filled once by _init_worker
+_WORKER = {}
+
+
+def _init_worker(models, datastruct):
+    """Pool initializer: each worker process receives the surrogate models once"""
+    _WORKER["models"] = models
+    _WORKER["datastruct"] = datastruct
+
+
+def _solve_agent(kwargs):
+    """
+    Best response of one agent inside a pool worker, along with the hits and
+    misses its prediction cache (if any) recorded during the solve and the
+    cache's size, the updated warm-start state and the solve's stats (when
+    instrumented)
+    """
+    models = _WORKER["models"]
+    before = models.stats() if isinstance(models, PredictionCache) else None
+    x, f = de_optimizer(datastruct=_WORKER["datastruct"], models=models, **kwargs)
+    counts = None
+    if before is not None:
+        after = models.stats()
+        counts = {k: after[k] - before[k] for k in ("hits", "misses")}
+        counts.update(size=after["size"], pid=os.getpid())
+    return x, f, counts, kwargs.get("warm_start"), kwargs.get("stats")
+
 
 class DiagonalizedSolver(object):
+    """
+    Diagonalization over the agents' best responses. update="gauss-seidel"
+    solves the agents one after another against the latest X, while
+    update="jacobi" solves every agent against the previous round's X and
+    applies the responses together, on n_jobs worker processes.
+    """
     
     def __init__(self, capcosts, caplimits, nodes, models, model_names, datastruct,
-                 action_increment=np.inf, regularize=False, alpha=1.):
+                 action_increment=np.inf, regularize=False, alpha=1.,
+                 update="gauss-seidel", n_jobs=1, seed=None):
+        if update not in ("gauss-seidel", "jacobi"):
+            raise ValueError("unknown update mode: {}".format(update))
         self.capcosts = capcosts
         self.caplimits = caplimits
         self.nodes = nodes
@@ -20,6 +67,22 @@ class DiagonalizedSolver(object):
         self.model_names = model_names
         self.gradient_based = False
         self.datastruct = datastruct
+        self.update = update
+        self.n_jobs = n_jobs
+        self.seed = seed
+        self._pool = None
+        self.restart_jobs = 1
+        self.cancel_tol = None
+        self.cache_stats = []
+        self._worker_cache_sizes = {}
+        self.warm_fraction = None
+        self.checkpoint_path = None
+        self.history_log = None
+        self.instrumentation = None
+        self.ownership = None
+        self.owned = None
+        self.set_update_scheme()
+        self.set_convergence_criteria()
         self.reset()
     
     def update_count(self):
@@ -27,47 +90,469 @@ class DiagonalizedSolver(object):
         
     def reset(self):
         self.X = np.zeros((self.num_agents, self.num_gens))
-        self.agents = {i: defaultdict(list) for i in range(self.num_agents)}
+        if self.history_log is not None:
+            self.history_log.truncate(0)
+            self.agents = {i: self.history_log.agent(i) for i in range(self.num_agents)}
+        else:
+            self.agents = {i: defaultdict(list) for i in range(self.num_agents)}
         self.iteration_count = 0
+        self.stop_reason = None
+        self.skipped = []
+        self._last_x_ineg = {}
+        self.warm_starts = {i: {} for i in range(self.num_agents)}
+        self.de_stats = []
+        self.residuals = []
+        self._col_total = self.X.sum(axis=0)
+        self.scheme.reset()
         
     def set_starting_cap(self, caps):
         self.X = caps
 
     def set_gradient_based(self):
         self.gradient_based = True
+
+    def set_prediction_cache(self, resolution=1., maxsize=100000):
+        """Put a PredictionCache in front of the models, keyed on x_tot rounded to resolution MW"""
+        self.close()
+        self.models = PredictionCache(self.models, resolution=resolution, maxsize=maxsize)
+
+    def set_update_scheme(self, scheme="plain", **options):
+        """
+        How a round's best responses G are combined with the X the round
+        started from into the next X: "plain" (X = G), "damping" (fixed
+        beta), "adaptive" (damping adjusted to the residual) or "anderson"
+        (Anderson acceleration over `window` rounds), see acceleration.
+        Other than with "plain", the result is projected onto [0, caplimits].
+        The agents' history keeps the best responses themselves, and the
+        residual norm |G - X| of every round is kept in residuals. The
+        scheme's history is part of the checkpoint (see set_checkpoint), so
+        a resumed run continues the acceleration where it stopped.
+        """
+        self.scheme_name = scheme
+        self.scheme_options = options
+        self.scheme = update_scheme(scheme, **options)
+
+    def set_ownership(self, mask=None):
+        """
+        Sparse agent-ownership: agent i only decides the technologies where
+        mask[i] is True (by default those with caplimits > 0). Its best
+        response searches those columns alone, with the other technologies
+        fixed at their current totals, and only their models are
+        evaluated. The in-memory history keeps the owned columns only (see
+        get_agent_decisions) and the other entries of X[i] are left as they
+        are. Agents owning nothing are not solved. Applies to the DE and
+        grid optimizers; the gradient-based path still solves every column.
+        """
+        mask = self.caplimits > 0 if mask is None else np.asarray(mask, dtype=bool)
+        if mask.shape != (self.num_agents, self.num_gens):
+            raise ValueError("ownership mask must have shape {}".format((self.num_agents, self.num_gens)))
+        self.ownership = mask
+        self.owned = [np.flatnonzero(row) for row in mask]
+
+    def set_convergence_criteria(self, x_tol=None, f_rtol=None, time_limit=None, skip_tol=None):
+        """
+        Stopping rules for iterate, each disabled when None: the largest
+        change of any entry of X in a round (of the best responses G
+        relative to X, with an update scheme other than "plain"), the
+        largest relative change of an agent's objective in a round, and a
+        wall-clock budget in seconds.
+        With skip_tol set, an agent is not re-solved (its last decision is
+        kept) while its competitors' aggregate x_ineg has not moved by more
+        than skip_tol since its last solve.
+        """
+        self.x_tol = x_tol
+        self.f_rtol = f_rtol
+        self.time_limit = time_limit
+        self.skip_tol = skip_tol
+
+    def set_warm_start(self, warm_fraction=0.5):
+        """
+        Seed each agent's DE population from the best members of its previous
+        solve (see de_optimizer); the evaluations used per round are kept in
+        de_stats
+        """
+        self.warm_fraction = warm_fraction
+
+    def set_checkpoint(self, path, every=1, _num_records=None):
+        """
+        Write the solver and RNG state to `path` (an .npz file, replaced
+        atomically) every `every` rounds. The agents' x/f history moves to
+        an append-only log at path + ".log" instead of in-memory lists.
+        """
+        self.checkpoint_path = path
+        self.checkpoint_every = every
+        log = HistoryLog(path + ".log", self.num_gens)
+        if _num_records is not None:
+            # drop records of a round that was not checkpointed
+            log.truncate(_num_records)
+        else:
+            log.truncate(0)
+            for i in range(self.num_agents):
+                for x, f in zip(self.agents[i]["x"], self.agents[i]["f"]):
+                    log.append(-1, i, self._expand_decision(i, x), f)
+            log.flush()
+        self.history_log = log
+        self.agents = {i: log.agent(i) for i in range(self.num_agents)}
+
+    def save_checkpoint(self):
+        """Write the checkpoint now, see set_checkpoint"""
+        self.history_log.flush()
+        settings = dict(model_names=list(self.model_names), action_increment=float(self.action_increment),
+                        regularize=self.regularize, alpha=self.alpha, update=self.update,
+                        n_jobs=self.n_jobs, seed=None if self.seed is None else int(self.seed), gradient_based=self.gradient_based,
+                        iteration_count=self.iteration_count, restart_jobs=self.restart_jobs,
+                        cancel_tol=self.cancel_tol, warm_fraction=self.warm_fraction,
+                        x_tol=self.x_tol, f_rtol=self.f_rtol, time_limit=self.time_limit,
+                        skip_tol=self.skip_tol, every=self.checkpoint_every,
+                        scheme=self.scheme_name, scheme_options=self.scheme_options,
+                        num_records=len(self.history_log))
+        arrays = dict(capcosts=self.capcosts, caplimits=self.caplimits, nodes=np.array(self.nodes),
+                      X=self.X)
+        last_x_ineg = np.full((self.num_agents, self.num_gens), np.nan)
+        for i, x_ineg in self._last_x_ineg.items():
+            last_x_ineg[i] = x_ineg
+        arrays["last_x_ineg"] = last_x_ineg
+        if self.ownership is not None:
+            arrays["ownership"] = self.ownership
+        arrays["residuals"] = np.array(self.residuals, dtype=float)
+        for key, value in self.scheme.get_state().items():
+            arrays["scheme_" + key] = value
+        for i, ws in self.warm_starts.items():
+            if "population" in ws:
+                arrays["warm_population_{}".format(i)] = ws["population"]
+        rng_name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        settings["rng"] = [rng_name, int(pos), int(has_gauss), float(cached_gaussian)]
+        arrays["rng_keys"] = keys
+        atomic_savez(self.checkpoint_path, settings=np.array(json.dumps(settings)), **arrays)
+
+    @classmethod
+    def resume(cls, path, models, datastruct):
+        """
+        Solver continuing from the checkpoint at `path`. The surrogate
+        models and datastruct are not part of the checkpoint and are given
+        again.
+        """
+        with np.load(path) as ck:
+            settings = json.loads(str(ck["settings"]))
+            solver = cls(ck["capcosts"], ck["caplimits"], ck["nodes"], models,
+                         settings["model_names"], datastruct,
+                         action_increment=settings["action_increment"],
+                         regularize=settings["regularize"], alpha=settings["alpha"],
+                         update=settings["update"], n_jobs=settings["n_jobs"], seed=settings["seed"])
+            solver.X = ck["X"].copy()
+            for i in range(solver.num_agents):
+                if not np.isnan(ck["last_x_ineg"][i]).any():
+                    solver._last_x_ineg[i] = ck["last_x_ineg"][i].copy()
+                key = "warm_population_{}".format(i)
+                if key in ck.files:
+                    solver.warm_starts[i]["population"] = ck[key].copy()
+            if "ownership" in ck.files:
+                solver.set_ownership(ck["ownership"])
+            if "residuals" in ck.files:
+                solver.residuals = ck["residuals"].tolist()
+            scheme_state = {k[len("scheme_"):]: ck[k] for k in ck.files if k.startswith("scheme_")}
+            rng_name, pos, has_gauss, cached_gaussian = settings["rng"]
+            np.random.set_state((rng_name, ck["rng_keys"], pos, has_gauss, cached_gaussian))
+        solver.iteration_count = settings["iteration_count"]
+        solver.gradient_based = settings["gradient_based"]
+        solver.set_restart_options(settings["restart_jobs"], settings["cancel_tol"])
+        if settings["warm_fraction"] is not None:
+            solver.set_warm_start(settings["warm_fraction"])
+        solver.set_convergence_criteria(settings["x_tol"], settings["f_rtol"],
+                                        settings["time_limit"], settings["skip_tol"])
+        solver.set_update_scheme(settings["scheme"], **settings["scheme_options"])
+        solver.scheme.set_state(scheme_state)
+        solver.set_checkpoint(path, settings["every"], _num_records=settings["num_records"])
+        return solver
+
+    def set_instrumentation(self, sink=None):
+        """
+        Record every agent solve (see instrument.Instrumentation) in
+        self.instrumentation, appended to the JSON-lines file `sink` after
+        each round when given
+        """
+        self.instrumentation = Instrumentation(sink)
+
+    def set_restart_options(self, n_jobs=1, cancel_tol=None):
+        """
+        Run each agent's restarts on n_jobs threads, see optimize._run_restarts.
+        Each thread predicts with its own copy of XGBoost models; Keras models
+        cannot be copied and their predict calls are serialized.
+        """
+        self.restart_jobs = n_jobs
+        self.cancel_tol = cancel_tol
         
 #     def set_inverse_transform(self):
 #         self.x_inv_trans = self.datastruct.capacity.max().max()
 #         self.y_inv_trans = self.datastruct.revenue.max().max()
         
+    def close(self):
+        """Shut down the Jacobi worker pool, if one was started"""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        self._worker_cache_sizes = {}
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.n_jobs, initializer=_init_worker,
+                                              initargs=(self.models, self.datastruct))
+        return self._pool
+
+    def _agent_seed(self, i):
+        """Seed for agent i in the current round, None if the solver is unseeded"""
+        if self.seed is None:
+            return None
+        ss = np.random.SeedSequence([self.seed, self.iteration_count, i])
+        return int(ss.generate_state(1)[0])
+
+    def _agent_kwargs(self, i, X):
+        kwargs = dict(x=X, i=i, nodes=self.nodes, capcosts=self.capcosts[i, :],
+                      caplimits=self.caplimits[i, :], iteration_count=self.iteration_count,
+                      action_incr=self.action_increment, regularize=self.regularize,
+                      alpha=self.alpha, seed=self._agent_seed(i), n_jobs=self.restart_jobs,
+                      cancel_tol=self.cancel_tol)
+        if self.warm_fraction is not None and not self.gradient_based:
+            kwargs.update(warm_start=self.warm_starts[i], warm_fraction=self.warm_fraction)
+        if self.instrumentation is not None:
+            kwargs["stats"] = {}
+        if self.owned is not None and not self.gradient_based:
+            kwargs.update(columns=self.owned[i], x_ineg=self._x_ineg(i))
+        return kwargs
+
+    def _record_de_stats(self, i):
+        if self.warm_fraction is not None and "nfev" in self.warm_starts[i]:
+            ws = self.warm_starts[i]
+            self.de_stats[-1][i] = (ws["nfev"], ws["nit"], ws.get("seeded", False))
+
+    def _x_ineg(self, i):
+        """
+        Competitors' total capacity in the current X, from its column totals
+        kept in _col_total; with ownership, agent i's columns outside its
+        own count as fixed capacity too
+        """
+        if self.owned is None:
+            return self._col_total - self.X[i, :]
+        x_ineg = self._col_total.copy()
+        x_ineg[self.owned[i]] -= self.X[i, self.owned[i]]
+        return x_ineg
+
+    def _idle(self, i):
+        """Agent i owns no technology: nothing to solve"""
+        self._instrument(i, dict(optimizer=None, wall_time=0., nfev=0, njev=0, nit=0, restarts=0,
+                                 status="idle"))
+        return self.X[i].copy(), 0.
+
+    def _instrument(self, i, stats):
+        if self.instrumentation is not None:
+            self.instrumentation.record(self.iteration_count, i, stats)
+
+    def _skip(self, i):
+        self.skipped[-1].append(i)
+        self._instrument(i, dict(optimizer=None, wall_time=0., nfev=0, njev=0, nit=0, restarts=0,
+                                 status="skipped"))
+        return self._previous(i)
+
+    def _skippable(self, i):
+        """Whether agent i's competitors have stayed within skip_tol since its last solve"""
+        if self.skip_tol is None or i not in self._last_x_ineg:
+            return False
+        return np.abs(self._x_ineg(i) - self._last_x_ineg[i]).max() <= self.skip_tol
+
+    def _expand_decision(self, i, x):
+        """
+        A decision from the history as a full-length vector, the columns
+        agent i does not own taken from X[i] (see set_ownership)
+        """
+        x = np.asarray(x).reshape(-1)
+        if x.size == self.num_gens:
+            return x
+        full = self.X[i].copy()
+        full[self.owned[i]] = x
+        return full
+
+    def _previous(self, i):
+        return self._expand_decision(i, self.agents[i]["x"][-1]), self.agents[i]["f"][-1]
+
+    def _solve(self, i, X):
+        if self.owned is not None and self.owned[i].size == 0:
+            return self._idle(i)
+        if self._skippable(i):
+            return self._skip(i)
+        self._last_x_ineg[i] = self._x_ineg(i)
+        optimizer = gradient_optimizer if self.gradient_based else de_optimizer
+        kwargs = self._agent_kwargs(i, X)
+        x, f = optimizer(datastruct=self.datastruct, models=self.models, **kwargs)
+        self._record_de_stats(i)
+        if "stats" in kwargs:
+            self._instrument(i, kwargs["stats"])
+        return x, f
+
+    def _record(self, i, x, f):
+        x = np.asarray(x).reshape(-1)
+        cols = slice(None) if self.owned is None else self.owned[i]
+        self._col_total[cols] += x[cols] - self.X[i, cols]
+        self.X[i, cols] = x[cols]
+        if self.history_log is not None:
+            self.history_log.append(self.iteration_count, i, self.X[i].copy(), f)
+        else:
+            self.agents[i]["x"].append(x if self.owned is None else x[cols])
+            self.agents[i]["f"].append(f)
+
+    def _gauss_seidel_step(self):
+        for i in range(self.num_agents):
+            x, f = self._solve(i, self.X)
+            self._record(i, x, f)
+
+    def _jacobi_step(self):
+        X_prev = self.X.copy()
+        # Keras sessions cannot be shared with worker processes, so the
+        # gradient-based path solves the Jacobi round in this process
+        if self.n_jobs > 1 and not self.gradient_based:
+            idle = [i for i in range(self.num_agents) if self.owned is not None and self.owned[i].size == 0]
+            skip = [i for i in range(self.num_agents) if i not in idle and self._skippable(i)]
+            solve = [i for i in range(self.num_agents) if i not in skip and i not in idle]
+            for i in solve:
+                self._last_x_ineg[i] = self._x_ineg(i)
+            tasks = [self._agent_kwargs(i, X_prev) for i in solve]
+            results = {i: self._skip(i) for i in skip}
+            results.update((i, self._idle(i)) for i in idle)
+            for i, (x, f, counts, warm_start, stats) in zip(solve, self._get_pool().map(_solve_agent, tasks)):
+                if counts is not None:
+                    self.models.hits += counts["hits"]
+                    self.models.misses += counts["misses"]
+                    self._worker_cache_sizes[counts["pid"]] = counts["size"]
+                if warm_start is not None:
+                    self.warm_starts[i] = warm_start
+                    self._record_de_stats(i)
+                if stats is not None:
+                    self._instrument(i, stats)
+                results[i] = (x, f)
+            results = [results[i] for i in range(self.num_agents)]
+        else:
+            results = [self._solve(i, X_prev) for i in range(self.num_agents)]
+        for i, (x, f) in enumerate(results):
+            self._record(i, x, f)
+
+    def _round_state(self):
+        """What step changes before a round completes, see _restore_round"""
+        return dict(X=self.X.copy(), iteration_count=self.iteration_count,
+                    num_records=None if self.history_log is None else len(self.history_log),
+                    rounds=len(self.skipped), residuals=len(self.residuals),
+                    last_x_ineg=dict(self._last_x_ineg), scheme=self.scheme.get_state())
+
+    def _restore_round(self, state):
+        """Undo a round interrupted before it completed (warm starts keep what it found)"""
+        self.X = state["X"]
+        self._col_total = self.X.sum(axis=0)
+        if state["num_records"] is not None:
+            self.history_log.flush()
+            self.history_log.truncate(state["num_records"])
+        del self.skipped[state["rounds"]:], self.de_stats[state["rounds"]:]
+        del self.residuals[state["residuals"]:]
+        self._last_x_ineg = state["last_x_ineg"]
+        self.scheme.reset()
+        self.scheme.set_state(state["scheme"])
+
     def step(self):
+        """
+        One round of best responses. On KeyboardInterrupt with checkpointing
+        on, an unfinished round is undone and the checkpoint written before
+        the interrupt is re-raised, so a resume continues from the last
+        completed round.
+        """
+        start = self._round_state() if self.checkpoint_path is not None else None
+        self.skipped.append([])
+        self.de_stats.append({})
+        X_prev = self.X.copy()
+        self._col_total = self.X.sum(axis=0)
         try:
-            for i in range(self.num_agents):
-                if self.gradient_based:
-                    x, f = gradient_optimizer(self.X, i, self.nodes, self.capcosts[i, :], 
-                                        self.caplimits[i, :], self.datastruct, self.models, self.iteration_count, self.action_increment,
-                                        regularize=self.regularize, alpha=self.alpha)
-                else:
-                    x, f = de_optimizer(self.X, i, self.nodes, self.capcosts[i, :], 
-                                        self.caplimits[i, :], self.datastruct, self.models, self.iteration_count, self.action_increment,
-                                        regularize=self.regularize, alpha=self.alpha)
-                self.agents[i]["x"].append(x)
-                self.agents[i]["f"].append(f)
-                self.X[i, :] = x.squeeze()
+            if self.update == "jacobi":
+                self._jacobi_step()
+            else:
+                self._gauss_seidel_step()
+            self._best_responses = self.X.copy()
+            self.residuals.append(float(np.linalg.norm(self.X - X_prev)))
+            if self.scheme_name != "plain":
+                self.X = np.clip(self.scheme(X_prev, self.X), 0., self.caplimits)
+            if self.instrumentation is not None:
+                self.instrumentation.flush()
             self.update_count()
+            if self.checkpoint_path is not None and self.iteration_count % self.checkpoint_every == 0:
+                self.save_checkpoint()
         except KeyboardInterrupt:
-            raise("interrupted")
-            
-            
-    def iterate(self, num_steps):
+            if start is not None:
+                if self.iteration_count == start["iteration_count"]:
+                    self._restore_round(start)
+                self.save_checkpoint()
+                logger.info("interrupted, checkpoint written after round %d", self.iteration_count)
+            raise
+
+    def _converged(self, X_prev):
+        """Name of the first convergence rule met by the last round, if any"""
+        if self.x_tol is not None and np.abs(self._best_responses - X_prev).max() <= self.x_tol:
+            return "x_tol"
+        if self.f_rtol is not None and all(len(self.agents[i]["f"]) > 1 for i in self.agents):
+            f_rel = max(abs(a["f"][-1] - a["f"][-2]) / max(abs(a["f"][-2]), np.finfo(float).eps)
+                        for a in self.agents.values())
+            if f_rel <= self.f_rtol:
+                return "f_rtol"
+        return None
+
+    def iterate(self, num_steps, verbose=False):
+        """
+        Run up to num_steps rounds, stopping early on the rules given to
+        set_convergence_criteria. Returns the number of rounds used; the
+        reason is kept in stop_reason. Progress is logged at INFO level;
+        verbose=True prints it to stderr (see instrument.log_to_console).
+        """
+        if verbose:
+            log_to_console()
+        cached = isinstance(self.models, PredictionCache)
+        tic = time.time()
+        self.stop_reason = "num_steps"
+        rounds = 0
         for n in range(num_steps):
-            print("round {}/{}, total capacity = {:1.3e}".format(n+1, num_steps, self.X.sum()))
+            logger.info("round %d/%d, total capacity = %1.3e", n+1, num_steps, self.X.sum())
+            if cached:
+                self.models.reset_stats()
+            X_prev = self.X.copy()
             self.step()
+            rounds += 1
+            logger.info("  residual |G - X| = %1.3e", self.residuals[-1])
+            if cached:
+                stats = self.models.stats()
+                # the Jacobi workers fill their own caches, not this one
+                stats["size"] += sum(self._worker_cache_sizes.values())
+                self.cache_stats.append(stats)
+                logger.info("  prediction cache: %d hits, %d misses, %d entries",
+                            stats["hits"], stats["misses"], stats["size"])
+            if self.de_stats[-1]:
+                nfev = sum(v[0] for v in self.de_stats[-1].values())
+                nit = sum(v[1] for v in self.de_stats[-1].values())
+                first = sum(v[0] for v in self.de_stats[0].values())
+                seeded = sum(v[2] for v in self.de_stats[-1].values())
+                logger.info("  DE: %d evaluations, %d generations (%.0f%% of the first round's evaluations), "
+                            "%d of %d solves warm-started", nfev, nit, 100. * nfev / max(first, 1),
+                            seeded, len(self.de_stats[-1]))
+            if self.skipped[-1]:
+                logger.info("  skipped agents: %s", self.skipped[-1])
+            reason = self._converged(X_prev)
+            if reason is None and self.time_limit is not None and time.time() - tic >= self.time_limit:
+                reason = "time_limit"
+            if reason is not None:
+                self.stop_reason = reason
+                break
+        logger.info("stopped after %d rounds: %s", rounds, self.stop_reason)
+        return rounds
             
     def get_agent_decisions(self):
-        return {i: np.vstack(self.agents[i]["x"]).squeeze() for i in self.agents}
+        return {i: np.vstack([self._expand_decision(i, x) for x in self.agents[i]["x"]]).squeeze()
+                for i in self.agents}
 
     def plot_convergence(self):
+        import matplotlib.pyplot as plt
         for i in range(solver.num_agents):
             plt.plot(solver.agents[i]['f'],)
         plt.title("Agents Objective function vs Iterations")
@@ -76,6 +561,7 @@ class DiagonalizedSolver(object):
         
         
     def plot_convergence_techonology(self):
+        import matplotlib.pyplot as plt
         fig, ax = plt.subplots(2, math.ceil(len(self.num_gens)/2))
         fig.set_size_inches(16, 10)
         axf = ax.flatten()
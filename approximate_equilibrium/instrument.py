@@ -0,0 +1,128 @@
+import json
+import logging
+import time
+
+import numpy as np
+
+
+def log_to_console(level=logging.INFO):
+    """
+    Print the package's log records (e.g. the solver's per-round progress)
+    to stderr. The package itself configures no handler, so without this
+    (or logging.basicConfig) nothing is shown. Calling it again only
+    changes the level.
+    """
+    logger = logging.getLogger("approximate_equilibrium")
+    logger.setLevel(level)
+    for handler in logger.handlers:
+        if getattr(handler, "_console", False):
+            return handler
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(message)s", "%H:%M:%S"))
+    handler._console = True
+    logger.addHandler(handler)
+    return handler
+
+
+class LatencyTimer(object):
+    """Wall time of every call made through the functions and models it wraps"""
+
+    def __init__(self):
+        self.latencies = []
+
+    def wrap(self, func):
+        def timed(*args, **kwargs):
+            tic = time.perf_counter()
+            out = func(*args, **kwargs)
+            self.latencies.append(time.perf_counter() - tic)
+            return out
+        return timed
+
+    def wrap_models(self, models):
+        return TimedModels(models, self)
+
+
+class _TimedModel(object):
+
+    def __init__(self, model, timer):
+        self.model = model
+        self.predict = timer.wrap(model.predict)
+
+
+class TimedModels(object):
+    """
+    Model set timing the surrogate predict calls made by objective_function
+    and objective_function_batch: predict of each model, or predict_all when
+    the wrapped set has one (e.g. PredictionCache)
+    """
+
+    def __init__(self, models, timer):
+        self.models = models
+        self.timer = timer
+        if hasattr(models, "predict_all"):
+            self.predict_all = timer.wrap(models.predict_all)
+
+    def __len__(self):
+        return len(self.models)
+
+    def __getitem__(self, ix):
+        # model sets such as CompiledTreeEnsemble only offer predict_all
+        return _TimedModel(self.models[ix], self.timer)
+
+
+def summarize(stats):
+    """
+    Flat record of the stats dict filled by an optimizer: the raw predict
+    latencies are replaced by their count and 50/90/99th percentiles in ms
+    """
+    record = {k: v for k, v in stats.items() if k != "predict_latency"}
+    latency = np.asarray(stats.get("predict_latency", ()), dtype=float) * 1e3
+    record["predict_calls"] = int(latency.size)
+    for q in (50, 90, 99):
+        record["predict_p{}_ms".format(q)] = float(np.percentile(latency, q)) if latency.size else None
+    return record
+
+
+class Instrumentation(object):
+    """
+    Per-agent, per-round solve records of a DiagonalizedSolver: wall time,
+    objective and gradient evaluations, surrogate predict latency
+    percentiles, optimizer iterations and termination status. Records are
+    kept in memory and, with a sink path, appended to it as JSON lines at
+    the end of every round.
+    """
+
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.records = []
+        self._flushed = 0
+
+    def record(self, round, agent, stats):
+        rec = {"round": int(round), "agent": int(agent)}
+        rec.update(summarize(stats))
+        self.records.append(rec)
+        return rec
+
+    def flush(self):
+        if self.sink is None or self._flushed == len(self.records):
+            return
+        with open(self.sink, "a") as f:
+            for rec in self.records[self._flushed:]:
+                f.write(json.dumps(rec) + "\n")
+        self._flushed = len(self.records)
+
+    def table(self):
+        """All records as a DataFrame, one row per agent solve"""
+        import pandas as pd
+        return pd.DataFrame(self.records)
+
+    def round_table(self):
+        """Totals per round: wall time, evaluations, iterations and skipped agents"""
+        table = self.table()
+        if table.empty:
+            return table
+        grouped = table.groupby("round")
+        out = grouped[["wall_time", "nfev", "njev", "nit"]].sum()
+        out["skipped"] = grouped["status"].apply(lambda s: int((s == "skipped").sum()))
+        out["predict_p99_ms"] = grouped["predict_p99_ms"].max()
+        return out
@@ -1,26 +1,25 @@
 import glob
+import inspect
+import itertools
 import os
 import pickle
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 import numpy as np
-import seaborn as sns
-import matplotlib.pyplot as plt
 import math
-from sklearn.model_selection import train_test_split as tts
-from sklearn.linear_model import LinearRegression, SGDRegressor, HuberRegressor
-from sklearn.neighbors import KNeighborsRegressor
-from sklearn.svm import SVR, LinearSVR
-from sklearn.gaussian_process import GaussianProcessRegressor, kernels
-from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
-from sklearn.neural_network import MLPRegressor
-from sklearn.preprocessing import MinMaxScaler
-from sklearn.model_selection import GridSearchCV
-from xgboost import XGBRegressor
-
-
-def scale(xtrain, xtest, scaler=MinMaxScaler):
+
+# sklearn, xgboost and matplotlib are imported by the functions that use
+# them, so importing this module stays cheap
+
+XGB_PARAMS = dict(objective="reg:squarederror", booster="gbtree",
+                  max_depth=5, n_estimators=300, learning_rate=0.1)
+
+
+def scale(xtrain, xtest, scaler=None):
+    if scaler is None:
+        from sklearn.preprocessing import MinMaxScaler as scaler
     if np.ndim(xtrain) == 1:
         xtrain = xtrain.reshape(len(xtrain), 1)
         xtest = xtest.reshape(len(xtest), 1)
@@ -29,31 +28,87 @@ def scale(xtrain, xtest, scaler=MinMaxScaler):
     xtest = scaler.transform(xtest)
     return xtrain, xtest, scaler
 
-def model_fit(D):
+def _xgb_regressor(params=None, nthread=None):
+    """XGBRegressor with XGB_PARAMS and params, on nthread threads (the library default when None)"""
+    from xgboost import XGBRegressor
+    params = dict(XGB_PARAMS, **(params or {}))
+    if nthread is not None:
+        params["n_jobs"] = nthread
+    return XGBRegressor(**params)
+
+
+def _thread_budget(n_jobs, nthread=None):
+    """
+    xgboost threads per model when n_jobs models are trained at once:
+    nthread if given, else the cores split between the concurrent fits
+    (None, the library default, when fitting one at a time)
+    """
+    if nthread is not None or n_jobs <= 1:
+        return nthread
+    return max(1, (os.cpu_count() or 1) // n_jobs)
+
+
+def _release_threads(models):
+    """
+    Drop the training-time thread budget from fitted models, so that
+    prediction (and the saved models) use the library default of all cores
+    """
+    for model in models:
+        model.set_params(n_jobs=None)
+        model.get_booster().set_param("nthread", 0)
+    return models
+
+
+def _fit_xgb(model, xtrain, ytrain, eval_set=None, early_stopping_rounds=None, xgb_model=None):
+    """model.fit, optionally continuing from the booster xgb_model and early-stopping on eval_set"""
+    kwargs = {}
+    if eval_set is not None:
+        kwargs.update(eval_set=eval_set, verbose=False)
+        if early_stopping_rounds is not None:
+            if "early_stopping_rounds" in inspect.signature(model.fit).parameters:
+                kwargs["early_stopping_rounds"] = early_stopping_rounds
+            else:
+                # newer xgboost takes it as a model parameter
+                model.set_params(early_stopping_rounds=early_stopping_rounds)
+    model.fit(xtrain, ytrain, xgb_model=xgb_model, **kwargs)
+    return model
+
+
+def _rmse(model, x, y):
+    return float(np.sqrt(((model.predict(x) - np.asarray(y).reshape(-1))**2).mean()))
+
+
+def model_fit(D, n_jobs=1, nthread=None):
+    """
+    Fit one XGBRegressor per device and plot its predictions. The models
+    are fitted concurrently on n_jobs threads, each using nthread xgboost
+    threads (by default the cores split between them, see _thread_budget).
+    """
+    import matplotlib.pyplot as plt
+    from sklearn.model_selection import train_test_split as tts
+
     # Configure plot
     fig, ax = plt.subplots(2, math.ceil(len(D.devices)/2))
     fig.set_size_inches(16, 10)
     axf = ax.flatten()
-    models = []
 
-    for gen_idx in range(len(D.devices)):
-        # Create Data Sets for Training and Testing
-        y = D.revenue.values[:, gen_idx]
-        y = y.reshape(len(y), 1)
-        xtrain, xtest, ytrain, ytest = tts(D.capacity.values, y, train_size=.75, random_state=42)
-        print(xtrain.shape, xtest.shape, ytrain.shape, ytest.shape)
+    # Create Data Sets for Training and Testing, the same split for every device
+    xtrain, xtest, Ytrain, Ytest = tts(D.capacity.values, D.revenue.values, train_size=.75, random_state=42)
+    print(xtrain.shape, xtest.shape, Ytrain.shape, Ytest.shape)
 
-        # Pick a Model
+    # Pick a Model and train/fit it to the data provided
+    # model = tuned_model(xgb_model, xtrain, ytrain)
+    nthread = _thread_budget(n_jobs, nthread)
 
-        model = XGBRegressor(objective="reg:squarederror", booster="gbtree",
-                                max_depth=5, n_estimators=300, learning_rate=0.1)
-        
-        # model = tuned_model(xgb_model, xtrain, ytrain)
+    def fit(gen_idx):
+        return _fit_xgb(_xgb_regressor(nthread=nthread), xtrain, Ytrain[:, gen_idx])
 
-        # Train/Fit the model to the data provided
-        model.fit(xtrain, ytrain)
-        models.append(model)
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        models = _release_threads(list(pool.map(fit, range(len(D.devices)))))
 
+    for gen_idx, model in enumerate(models):
+        ytrain = Ytrain[:, [gen_idx]]
+        ytest = Ytest[:, [gen_idx]]
         ytest_pred = model.predict(xtest).reshape(-1, 1)
         ytrain_pred = model.predict(xtrain).reshape(-1, 1)
 
@@ -71,7 +126,50 @@ def model_fit(D):
 
     return models
 
+
+def fit_models(D, n_jobs=1, nthread=None, params=None, early_stopping_rounds=20,
+               validation_fraction=0.2, previous=None, random_state=42):
+    """
+    Fit one XGBRegressor per device on D.capacity -> D.revenue, without
+    plotting. The models are fitted concurrently on n_jobs threads, each
+    using nthread xgboost threads (by default the cores split between
+    them); the returned models predict on all cores.
+    A validation_fraction of the samples is held out and training stops
+    after early_stopping_rounds rounds without improvement on it.
+
+    previous (a list of models, or a file written by save_models) continues
+    boosting from those models' trees instead of starting from scratch,
+    e.g. once new samples have been added to D; params["n_estimators"]
+    is then the number of rounds added.
+    """
+    from sklearn.model_selection import train_test_split as tts
+    if isinstance(previous, str):
+        previous = load_models(previous)
+    X, Y = D.capacity.values, D.revenue.values
+    if validation_fraction:
+        xtrain, xval, Ytrain, Yval = tts(X, Y, test_size=validation_fraction, random_state=random_state)
+    else:
+        xtrain, Ytrain = X, Y
+
+    nthread = _thread_budget(n_jobs, nthread)
+
+    def fit(gen_idx):
+        model = _xgb_regressor(params, nthread)
+        eval_set = [(xval, Yval[:, gen_idx])] if validation_fraction else None
+        booster = previous[gen_idx].get_booster() if previous is not None else None
+        return _fit_xgb(model, xtrain, Ytrain[:, gen_idx], eval_set, early_stopping_rounds, booster)
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        models = _release_threads(list(pool.map(fit, range(Y.shape[1]))))
+    if validation_fraction:
+        for gen_idx, model in enumerate(models):
+            print("{}: validation rmse = {:1.3e}".format(D.devices[gen_idx],
+                                                         _rmse(model, xval, Yval[:, gen_idx])))
+    return models
+
+
 def plot_capacity_vs_revenue(D, models):
+    import matplotlib.pyplot as plt
     fig, ax = plt.subplots(1, 2)
     fig.set_size_inches((16, 4))
     _ = ax[0].scatter(x=D.capacity.sum(axis=1), y=D.revenue.sum(axis=1), alpha=.5)
@@ -86,6 +184,7 @@ def plot_capacity_vs_revenue(D, models):
 
 
 def plot_revenue_per_capacity(D, models):
+    import matplotlib.pyplot as plt
     fig, ax = plt.subplots(2, math.ceil(len(D.devices)/2))
     fig.set_size_inches(16, 10)
     axf = ax.flatten()
@@ -103,17 +202,66 @@ def save_models(models, file_name):
         pickle.dump(models, f)
 
 
-def tuned_model(xgb_model, xtrain, ytrain):
+def load_models(file_name):
+    with open(file_name, "rb") as f:
+        return pickle.load(f)
+
+
+def halving_search(xtrain, ytrain, xval, yval, param_grid, base_params=None, max_rounds=300,
+                   factor=3, early_stopping_rounds=20, n_jobs=1, nthread=None):
+    """
+    Successive halving over the grid of XGBRegressor parameters param_grid
+    (a dict of lists, as for GridSearchCV). Every candidate is first
+    boosted for a small number of rounds; the best 1/factor by validation
+    RMSE are kept and retrained with factor times more rounds, up to
+    max_rounds. Candidates of a rung are trained concurrently on n_jobs
+    threads, each on nthread xgboost threads (see _thread_budget). Returns the best parameters, the best model and the
+    (rounds, params, rmse) history of every rung.
+    """
+    keys = sorted(k for k in param_grid if k != "n_estimators")
+    candidates = [dict(zip(keys, values)) for values in itertools.product(*[param_grid[k] for k in keys])]
+    rungs = int(np.ceil(np.log(len(candidates)) / np.log(factor))) if len(candidates) > 1 else 0
+    history = []
+    nthread = _thread_budget(n_jobs, nthread)
+
+    def fit(candidate, rounds):
+        model = _xgb_regressor(dict(base_params or {}, n_estimators=rounds, **candidate), nthread)
+        _fit_xgb(model, xtrain, ytrain, [(xval, yval)], early_stopping_rounds)
+        return model, _rmse(model, xval, yval)
+
+    for rung in range(rungs + 1):
+        rounds = max(1, int(round(max_rounds / factor**(rungs - rung))))
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            results = list(pool.map(fit, candidates, [rounds] * len(candidates)))
+        history.extend((rounds, c, r[1]) for c, r in zip(candidates, results))
+        order = np.argsort([r[1] for r in results], kind="stable")
+        keep = max(1, int(np.ceil(len(candidates) / factor)))
+        if rung < rungs:
+            candidates = [candidates[k] for k in order[:keep]]
+    best = order[0]
+    return dict(candidates[best], n_estimators=rounds), _release_threads([results[best][0]])[0], history
+
+
+def tuned_model(xgb_model, xtrain, ytrain, n_jobs=1, validation_fraction=0.2):
+    """
+    xgb_model refitted on xtrain with the tuning_dict parameters chosen by
+    halving_search on a held-out validation_fraction of xtrain
+    """
+    from sklearn.model_selection import train_test_split as tts
     tuning_dict = {'max_depth': [5, 6, 8],
                     'n_estimators': [300],
                     'learning_rate': [0.05, 0.1],
                     'min_child_weight':[1, 2, 3],
                     'subsample': [0.8]}
 
-    model = GridSearchCV(xgb_model, tuning_dict)
-
+    ytrain = np.asarray(ytrain).reshape(-1)
+    xfit, xval, yfit, yval = tts(xtrain, ytrain, test_size=validation_fraction, random_state=42)
+    base = {k: v for k, v in xgb_model.get_params().items() if v is not None}
+    best_params, best, history = halving_search(xfit, yfit, xval, yval, tuning_dict, base_params=base,
+                                                max_rounds=max(tuning_dict["n_estimators"]),
+                                                n_jobs=n_jobs)
+    print("validation rmse: {:1.3e}".format(min(h[2] for h in history if h[0] == best_params["n_estimators"])))
+    print(best_params)
+    model = xgb_model.__class__(**dict(base, **best_params))
     model.fit(xtrain, ytrain)
-    print(model.best_score_)
-    print(model.best_params_)
-    return model.best_estimator_
-
+    return model
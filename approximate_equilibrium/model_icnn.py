@@ -1,9 +1,3 @@
-from keras.layers import Input, Dense, Concatenate, Add
-from keras.activations import relu, linear
-from keras.constraints import NonNeg
-from keras import Model
-from keras.utils import plot_model
-from keras.callbacks import EarlyStopping
 import glob
 import os
 import pickle
@@ -11,19 +5,6 @@ from collections import defaultdict
 
 import pandas as pd
 import numpy as np
-import seaborn as sns
-import matplotlib.pyplot as plt
-
-from sklearn.model_selection import train_test_split as tts
-from sklearn.linear_model import LinearRegression, SGDRegressor, HuberRegressor
-from sklearn.neighbors import KNeighborsRegressor
-from sklearn.svm import SVR, LinearSVR
-from sklearn.gaussian_process import GaussianProcessRegressor, kernels
-from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
-from sklearn.neural_network import MLPRegressor
-from sklearn.preprocessing import MinMaxScaler
-from sklearn.model_selection import GridSearchCV
-from xgboost import XGBRegressor
 
 import time
 from copy import deepcopy
@@ -35,7 +16,7 @@ import warnings
 warnings.filterwarnings("ignore")
 
 def icnn_model(input_dim, output_dim, num_layers=3, num_units=256, 
-        hidden_activation="relu", output_activation="relu", constraint=NonNeg()):
+        hidden_activation="relu", output_activation="relu", constraint=None):
     """
     Create a ICNN with specified properties, following Section 3 in 
     http://proceedings.mlr.press/v70/amos17b/amos17b.pdf.
@@ -49,10 +30,16 @@ def icnn_model(input_dim, output_dim, num_layers=3, num_units=256,
         num_layers:  number of dense layers
         num_units:  number of hidden unites per dense layer
         activation:  activation function used in all layers
+        constraint:  kernel constraint of the W_i, NonNeg() by default
         
     Returns:
         model:  ICNN keras model object with specified properties
     """
+    from keras.layers import Input, Dense, Add
+    from keras.constraints import NonNeg
+    from keras import Model
+    if constraint is None:
+        constraint = NonNeg()
     
     u = Input(shape=(input_dim,), name="u")
 
@@ -74,19 +61,102 @@ def icnn_model(input_dim, output_dim, num_layers=3, num_units=256,
     return Model(inputs=u, outputs=z)
 
 
-def model_icnn(D):
+def array_sequence(x, y, batch_size=32, shuffle=True, seed=None):
+    """
+    keras.utils.Sequence over the rows of x and y, which may be memory
+    maps (np.load(..., mmap_mode="r")): each batch is a contiguous block
+    of rows read on demand, and with shuffle=True the order of the batches
+    is reshuffled after every epoch.
+    """
+    from keras.utils import Sequence
+
+    class ArraySequence(Sequence):
+
+        def __init__(self):
+            self.order = np.arange(int(np.ceil(len(x) / float(batch_size))))
+            self.rng = np.random.RandomState(seed)
+            self.on_epoch_end()
+
+        def __len__(self):
+            return len(self.order)
+
+        def __getitem__(self, ix):
+            start = self.order[ix] * batch_size
+            return np.asarray(x[start:start + batch_size]), np.asarray(y[start:start + batch_size])
+
+        def on_epoch_end(self):
+            if shuffle:
+                self.rng.shuffle(self.order)
+
+    return ArraySequence()
+
+
+def _split_order(n, train_size=.75, random_state=42):
+    """
+    Row order with the training rows first, then the test rows, each in the
+    order train_test_split(train_size=train_size, random_state=random_state)
+    returns them, and the number of training rows
+    """
+    n_train = int(np.floor(train_size * n))
+    perm = np.random.RandomState(random_state).permutation(n)
+    return np.concatenate([perm[n - n_train:], perm[:n - n_train]]), n_train
+
+
+def save_training_arrays(D, data_dir):
+    """
+    Write D.t_capacity and D.t_revenue to data_dir as .npy files, see
+    model_icnn. The rows are written in the shuffled train/test order of
+    _split_order, which is saved next to them as t_order.npy (the row of
+    D each stored row comes from).
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    order, _ = _split_order(len(D.t_capacity))
+    np.save(os.path.join(data_dir, "t_capacity.npy"), np.asarray(D.t_capacity)[order])
+    np.save(os.path.join(data_dir, "t_revenue.npy"), np.asarray(D.t_revenue)[order])
+    np.save(os.path.join(data_dir, "t_order.npy"), order)
+
+
+def _training_data(D, data_dir):
+    if data_dir is None:
+        from sklearn.model_selection import train_test_split as tts
+        return tts(D.t_capacity, D.t_revenue, train_size=.75, random_state=42)
+    # The arrays are stored shuffled, training rows first, so the split is
+    # the in-memory one and each part is a contiguous block of the memory map
+    if not os.path.exists(os.path.join(data_dir, "t_order.npy")):
+        raise ValueError("{} has no t_order.npy: write the arrays again with save_training_arrays".format(
+            data_dir))
+    x = np.load(os.path.join(data_dir, "t_capacity.npy"), mmap_mode="r")
+    y = np.load(os.path.join(data_dir, "t_revenue.npy"), mmap_mode="r")
+    n_train = _split_order(len(x))[1]
+    return x[:n_train], x[n_train:], y[:n_train], y[n_train:]
+
+
+def model_icnn(D, multi_output=False, data_dir=None, batch_size=32, epochs=100):
+    """
+    Train ICNNs on D.t_capacity -> D.t_revenue. By default one
+    single-output network is trained per technology; with multi_output=True
+    a single network predicts every technology (each output is still convex
+    in the input). With data_dir (see save_training_arrays) the arrays are
+    memory-mapped and streamed to Keras in batches by array_sequence; the
+    rows are stored in shuffled order, so the train/test split is the same
+    as in memory and the splits are contiguous blocks of rows.
+    """
+    from keras.callbacks import EarlyStopping
 
-    xtrain, xtest, ytrain, ytest = tts(D.t_capacity, D.t_revenue, train_size=.75, random_state=42)
-    models = np.array([icnn_model(xtrain.shape[1], 1) for x in range(ytrain.shape[1])])
+    xtrain, xtest, ytrain, ytest = _training_data(D, data_dir)
+    if multi_output:
+        models = np.array([icnn_model(xtrain.shape[1], ytrain.shape[1])])
+    else:
+        models = np.array([icnn_model(xtrain.shape[1], 1) for x in range(ytrain.shape[1])])
     model_ix = list(range(len(models))) 
 
     # Training params
     vbs = 0
     opt = "adam"
     loss = "mean_squared_error"
-    epochs = 100
     split = 0.25
     cbs = [EarlyStopping(monitor="val_loss", patience=5, restore_best_weights=True)]
+    n_fit = int((1. - split) * len(xtrain))
 
     # Fit each model
     history = []
@@ -94,16 +164,54 @@ def model_icnn(D):
         tic = time.time()
         print("model {}/{}".format(ix+1, len(model_ix)))
         model.compile(optimizer=opt, loss=loss)
-        h = model.fit(xtrain, ytrain[:, ix], verbose=vbs, epochs=epochs,
-                    validation_split=split, callbacks=cbs)
+        y = ytrain if multi_output else ytrain[:, ix:ix+1]
+        if data_dir is None:
+            h = model.fit(xtrain, y, verbose=vbs, epochs=epochs, batch_size=batch_size,
+                        validation_split=split, callbacks=cbs)
+        else:
+            h = model.fit_generator(array_sequence(xtrain[:n_fit], y[:n_fit], batch_size),
+                                    validation_data=array_sequence(xtrain[n_fit:], y[n_fit:],
+                                                                   batch_size, shuffle=False),
+                                    verbose=vbs, epochs=epochs, callbacks=cbs)
+        h.seconds = time.time() - tic
+        h.samples_per_second = n_fit * len(h.history["loss"]) / h.seconds
         history.append(h)
         models[ix] = model
-        print("elapsed: {:1.0f}s".format(time.time() - tic))
+        print("elapsed: {:1.0f}s, {:1.0f} samples/s".format(h.seconds, h.samples_per_second))
     
     return models, (xtrain, xtest, ytrain, ytest), history
 
 
+def predict_columns(models, x):
+    """Predictions of every technology for the rows of x, from per-technology or multi-output models"""
+    return np.hstack([np.asarray(model.predict(x)).reshape(len(x), -1) for model in models])
+
+
+def compare_icnn_training(D, data_dir=None, batch_size=32, epochs=100):
+    """
+    Train the per-technology ICNNs and a multi-output ICNN on the same
+    split and report, for each, the training time and throughput and the
+    test-set RMSE of every technology
+    """
+    import pandas as pd
+    errors, throughput = {}, {}
+    for name, multi_output in (("per_technology", False), ("multi_output", True)):
+        models, (xtrain, xtest, ytrain, ytest), history = model_icnn(
+            D, multi_output=multi_output, data_dir=data_dir, batch_size=batch_size, epochs=epochs)
+        seconds = sum(h.seconds for h in history)
+        throughput[name] = {"seconds": seconds,
+                            "samples_per_second": sum(h.samples_per_second * h.seconds for h in history) / seconds}
+        errors[name] = np.sqrt(((predict_columns(models, xtest) - np.asarray(ytest))**2).mean(axis=0))
+    errors = pd.DataFrame(errors, index=list(D.devices))
+    print("RMSE on test set")
+    print(errors.to_string(float_format="{:1.4f}".format))
+    for name, t in throughput.items():
+        print("{}: {:1.0f}s, {:1.0f} samples/s".format(name, t["seconds"], t["samples_per_second"]))
+    return errors, throughput
+
+
 def plot_loss(D, models, history):
+    import matplotlib.pyplot as plt
     # Plot loss curves
     model_ix = list(range(len(models))) 
     fig, ax = plt.subplots()
@@ -114,20 +222,21 @@ def plot_loss(D, models, history):
 def calculate_mse_error(D, models, training_data):
     # Evaluate error on test set
     (xtrain, xtest, ytrain, ytest) = training_data
-    model_ix = list(range(len(models))) 
+    pred = predict_columns(models, xtest)
     print("MSE on test set")
-    for ix, model in enumerate(models[model_ix]):
+    for ix in range(pred.shape[1]):
         print("{}: {:1.4f}".format(D.devices[ix], 
-                                np.sqrt(model.evaluate(xtest, ytest[:, ix], verbose=0))))
+                                np.sqrt(((pred[:, ix] - ytest[:, ix])**2).mean())))
 
 def plot_errors(D, models, training_data):
+    import matplotlib.pyplot as plt
     # Visualize the residual errors in test set
     (xtrain, xtest, ytrain, ytest) = training_data
-    model_ix = list(range(len(models))) 
-    for ix, model in enumerate(models[model_ix]):
+    pred = predict_columns(models, xtest)
+    for ix in range(pred.shape[1]):
         
         # Get predictions on test set
-        y_pred = model.predict(xtest)
+        y_pred = pred[:, ix].reshape(-1, 1)
         y_true = ytest[:, ix].reshape(-1, 1)
         
         # Create figure and params needed for plotting
@@ -0,0 +1,282 @@
+import glob
+import json
+import os
+import re
+import shutil
+
+import numpy as np
+
+from approximate_equilibrium.optimize.icnn import NumpyICNN, NumpyICNNEvaluator
+from approximate_equilibrium.optimize.trees import CompiledTreeEnsemble, _booster_json
+
+
+MANIFEST_FILE = "manifest.json"
+BANK_FORMAT = "approximate_equilibrium.modelbank"
+BANK_VERSION = 1
+
+_TREE_ARRAYS = ("feature", "threshold", "default_left", "value", "tree_offsets", "base_score")
+
+
+def _is_xgboost(model):
+    return hasattr(model, "get_booster")
+
+
+def _save_array(path, manifest, name, array):
+    np.save(os.path.join(path, name + ".npy"), np.ascontiguousarray(array))
+    manifest["arrays"].append(name)
+
+
+def _versions(path):
+    """Version numbers of the directories <path>.v<N> next to the bank at path"""
+    pattern = re.compile(re.escape(os.path.basename(path)) + r"\.v(\d+)$")
+    found = (pattern.match(os.path.basename(p)) for p in glob.glob(glob.escape(path) + ".v*"))
+    return sorted(int(m.group(1)) for m in found if m)
+
+
+def _new_version(path):
+    """Create and return the next free version directory of the bank at path"""
+    n = (_versions(path) or [0])[-1] + 1
+    while True:
+        version = "{}.v{}".format(path, n)
+        try:
+            os.makedirs(version)
+            return version
+        except FileExistsError:
+            n += 1
+
+
+def _point_to(path, version):
+    """Atomically make the symlink `path` point to the directory `version`"""
+    link = "{}.link-{}".format(path, os.getpid())
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(version), link)
+    if os.path.isdir(path) and not os.path.islink(path):
+        # bank written before versioning: keep it as a version of its own
+        legacy = _new_version(path)
+        os.rmdir(legacy)
+        os.rename(path, legacy)
+        try:
+            os.replace(link, path)
+        except OSError:
+            os.rename(legacy, path)
+            os.remove(link)
+            raise
+    else:
+        os.replace(link, path)
+
+
+def save_model_bank(path, models, devices, datastruct=None, keep_versions=None):
+    """
+    Write the per-technology surrogates to the directory `path`:
+    manifest.json (format version, model kind, feature order `devices` and,
+    given the DataStruct the models were trained on, its tranform_data
+    scaling constants) and one .npy file per array. XGBRegressor models
+    are stored as CompiledTreeEnsemble arrays plus each booster's JSON
+    document; Keras ICNNs (or NumpyICNN exports) as their float64 weight
+    matrices.
+
+    Each save writes a new directory <path>.v<N> and then atomically
+    repoints the symlink `path` to it, so readers always find a complete
+    bank at `path`, and banks loaded earlier (possibly memory-mapped by
+    other processes) stay on disk. keep_versions, when given, removes the
+    older versions beyond that many, counting the current one.
+    """
+    final = path.rstrip(os.sep)
+    version = _new_version(final)
+    try:
+        manifest = _write_bank(version, models, devices, datastruct)
+        _point_to(final, version)
+    except BaseException:
+        shutil.rmtree(version, ignore_errors=True)
+        raise
+    if keep_versions is not None:
+        current = os.path.realpath(final)
+        older = ["{}.v{}".format(final, n) for n in _versions(final)]
+        older = [v for v in older if os.path.realpath(v) != current]
+        for old in older[:max(len(older) - keep_versions + 1, 0)]:
+            shutil.rmtree(old)
+    return manifest
+
+
+def _write_bank(path, models, devices, datastruct=None):
+    """Write the manifest and arrays of a bank to the new directory `path`"""
+    manifest_file = os.path.join(path, MANIFEST_FILE)
+    manifest = {"format": BANK_FORMAT, "version": BANK_VERSION, "devices": [str(d) for d in devices],
+                "arrays": []}
+    if datastruct is not None:
+        manifest["scaling"] = {"capacity_max": float(datastruct.capacity.max().max()),
+                               "revenue_max": float(datastruct.revenue.max().max())}
+
+    models = list(models)
+    if all(_is_xgboost(m) for m in models):
+        manifest["kind"] = "xgboost"
+        compiled = CompiledTreeEnsemble.from_models(models)
+        for name in _TREE_ARRAYS:
+            _save_array(path, manifest, name, getattr(compiled, name))
+        manifest["boosters"] = []
+        for k, model in enumerate(models):
+            name = "booster_{}.json".format(k)
+            with open(os.path.join(path, name), "w") as f:
+                json.dump(_booster_json(model.get_booster()), f)
+            manifest["boosters"].append(name)
+    else:
+        manifest["kind"] = "icnn"
+        manifest["networks"] = []
+        for m, model in enumerate(models):
+            net = model if isinstance(model, NumpyICNN) else NumpyICNN.from_keras(model)
+            _save_array(path, manifest, "W_{}_out".format(m), net.W_out)
+            for k, W in enumerate(net.W):
+                _save_array(path, manifest, "W_{}_{}".format(m, k), W)
+            for k, (D, b) in enumerate(net.D):
+                _save_array(path, manifest, "D_{}_{}_kernel".format(m, k), D)
+                _save_array(path, manifest, "D_{}_{}_bias".format(m, k), b)
+            manifest["networks"].append({"layers": len(net.W), "activation": net.activation,
+                                         "output_activation": net.output_activation})
+
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    if manifest.get("format") != BANK_FORMAT:
+        raise ValueError("{} is not a model bank".format(path))
+    if manifest["version"] > BANK_VERSION:
+        raise ValueError("model bank version {} is newer than the supported version {}".format(
+            manifest["version"], BANK_VERSION))
+    return manifest
+
+
+def _bank_models(path, backend=None, mmap=True):
+    """The models stored in the bank at `path`, see ModelBank.load"""
+    # one version throughout, even if the bank is saved again meanwhile
+    path = os.path.realpath(path)
+    manifest = read_manifest(path)
+    mode = "r" if mmap else None
+
+    def array(name):
+        return np.load(os.path.join(path, name + ".npy"), mmap_mode=mode)
+
+    if manifest["kind"] == "xgboost":
+        backend = backend or "xgboost"
+        if backend == "xgboost":
+            from xgboost import XGBRegressor
+            models = []
+            for name in manifest["boosters"]:
+                model = XGBRegressor()
+                model.load_model(os.path.join(path, name))
+                models.append(model)
+            return models
+        if backend != "compiled":
+            raise ValueError("unknown backend for tree models: {}".format(backend))
+        models = CompiledTreeEnsemble(*[array(name) for name in _TREE_ARRAYS])
+    else:
+        backend = backend or "numpy"
+        nets = []
+        for m, info in enumerate(manifest["networks"]):
+            W = [array("W_{}_{}".format(m, k)) for k in range(info["layers"])]
+            D = [(array("D_{}_{}_kernel".format(m, k)), array("D_{}_{}_bias".format(m, k)))
+                 for k in range(info["layers"] - 1)]
+            nets.append(NumpyICNN(W, D, array("W_{}_out".format(m)), info["activation"],
+                                  info["output_activation"]))
+        if backend == "keras":
+            return [_to_keras(net) for net in nets]
+        if backend != "numpy":
+            raise ValueError("unknown backend for ICNN models: {}".format(backend))
+        models = NumpyICNNEvaluator(nets)
+    if mmap:
+        # pickled (e.g. for a worker pool) as a reference to the bank, so
+        # every process maps the same pages
+        models.source = (path, backend, mmap)
+    return models
+
+
+def _to_keras(net):
+    """Keras ICNN (model_icnn.icnn_model) carrying the weights of a NumpyICNN"""
+    from approximate_equilibrium.model_icnn import icnn_model
+    model = icnn_model(net.W[0].shape[0], net.output_dim, num_layers=len(net.D),
+                       num_units=net.W[0].shape[1], hidden_activation=net.activation,
+                       output_activation=net.output_activation)
+    model.get_layer("W_1").set_weights([np.array(net.W[0])])
+    for n, (W, (D, b)) in enumerate(zip(net.W[1:], net.D)):
+        model.get_layer("W_{}".format(n + 2)).set_weights([np.array(W)])
+        model.get_layer("D_{}".format(n + 2)).set_weights([np.array(D), np.array(b)])
+    model.get_layer("output").set_weights([np.array(net.W_out)])
+    return model
+
+
+class ModelBank(object):
+    """
+    Surrogate models loaded from a bank written by save_model_bank, with
+    its feature order (devices) and scaling constants. Tree models load by
+    default as XGBRegressors rebuilt from the boosters' JSON (backend=
+    "xgboost"), which predict the solver's large DE batches fastest;
+    backend="compiled" gives a CompiledTreeEnsemble over read-only memory
+    maps of the bank's arrays instead, cheaper to load and shared between
+    worker processes. ICNNs load by default as a NumpyICNNEvaluator over
+    memory maps (backend="numpy"); backend="keras" rebuilds Keras models.
+    """
+
+    def __init__(self, path, manifest, models):
+        self.path = path
+        self.manifest = manifest
+        self.models = models
+        self.devices = manifest["devices"]
+        self.scaling = manifest.get("scaling")
+
+    @classmethod
+    def load(cls, path, backend=None, mmap=True):
+        path = os.path.realpath(path)
+        return cls(path, read_manifest(path), _bank_models(path, backend, mmap))
+
+    @staticmethod
+    def save(path, models, devices, datastruct=None, keep_versions=None):
+        return save_model_bank(path, models, devices, datastruct, keep_versions)
+
+
+def benchmark_load(models, devices, path, repeat=5):
+    """
+    Seconds to load `models` from a pickle (save_models) and from a model
+    bank with its default and "compiled" backends, each followed by one
+    prediction of every technology, along with the size on disk of the
+    pickle and the bank. The files are written under `path`.
+    """
+    import pickle
+    import time
+    from approximate_equilibrium.model import save_models
+
+    os.makedirs(path, exist_ok=True)
+    pickle_file = os.path.join(path, "models.pkl")
+    bank_dir = os.path.join(path, "bank")
+    save_models(models, pickle_file)
+    save_model_bank(bank_dir, models, devices)
+    x = np.ones((1, len(devices)))
+
+    def load_pickle():
+        with open(pickle_file, "rb") as f:
+            loaded = pickle.load(f)
+        [m.predict(x) for m in loaded]
+
+    def predict(models):
+        if hasattr(models, "predict_all"):
+            return models.predict_all(x)
+        return [m.predict(x) for m in models]
+
+    def load_bank(backend=None):
+        return lambda: predict(ModelBank.load(bank_dir, backend).models)
+
+    results = {}
+    for name, load in (("pickle", load_pickle), ("bank", load_bank()), ("bank_compiled", load_bank("compiled"))):
+        load()
+        tic = time.perf_counter()
+        for _ in range(repeat):
+            load()
+        results[name + "_s"] = (time.perf_counter() - tic) / repeat
+    results["pickle_bytes"] = os.path.getsize(pickle_file)
+    results["bank_bytes"] = sum(os.path.getsize(os.path.join(bank_dir, f)) for f in os.listdir(bank_dir))
+    results["speedup"] = results["pickle_s"] / results["bank_s"]
+    results["speedup_compiled"] = results["pickle_s"] / results["bank_compiled_s"]
+    return results
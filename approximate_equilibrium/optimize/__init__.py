@@ -1 +1,31 @@
-from approximate_equilibrium.optimize.optimization import de_optimizer, objective_function, brute_force_optimizer, objective_function_iccn, gradient_optimizer
+import importlib
+
+# Public names and the submodules defining them, imported on first access
+_EXPORTS = {
+    "approximate_equilibrium.optimize.optimization": ["de_optimizer", "objective_function",
+                                                      "objective_function_batch",
+                                                      "brute_force_optimizer",
+                                                      "grid_optimizer",
+                                                      "objective_function_iccn",
+                                                      "gradient_optimizer"],
+    "approximate_equilibrium.optimize.cache": ["PredictionCache"],
+    "approximate_equilibrium.optimize.icnn": ["ICNNEvaluator", "NumpyICNN", "NumpyICNNEvaluator",
+                                              "icnn_evaluator", "icnn_parity", "clear_evaluators"],
+    "approximate_equilibrium.optimize.trees": ["CompiledTreeEnsemble", "benchmark_predict"],
+}
+
+_MODULE_OF = {name: module for module, names in _EXPORTS.items() for name in names}
+
+__all__ = list(_MODULE_OF)
+
+
+def __getattr__(name):
+    if name not in _MODULE_OF:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module(_MODULE_OF[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,127 @@
+import copy
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class PredictionCache(object):
+    """
+    LRU cache in front of the per-technology surrogate MODELS list.
+    Total-capacity vectors are quantized to `resolution` MW and each entry
+    holds the predictions of every technology at the quantized point, so a
+    single lookup serves the whole portfolio. The models are evaluated at
+    the quantized point, which keeps the results independent of the order
+    in which candidates arrive. At most `maxsize` vectors are kept.
+    Misses are evaluated in one predict_all call when the wrapped set has
+    one (compiled ensembles, ICNN evaluators, bank loads), otherwise with
+    one predict call per model. Lookups restricted to a subset of the technologies (see predict_all)
+    are cached separately and only evaluate those models.
+    """
+
+    def __init__(self, models, resolution=1., maxsize=100000):
+        self.models = models
+        self.resolution = resolution
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # thread_copy views count their hits and misses here
+        self._owner = self
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self.models)
+
+    def __getitem__(self, ix):
+        return self.models[ix]
+
+    def __iter__(self):
+        return iter(self.models)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def thread_safe(self):
+        # the entries are guarded by _lock, the model calls are not
+        return getattr(self.models, "thread_safe", False)
+
+    def thread_copy(self):
+        """
+        View of this cache for another thread, sharing its entries, lock
+        and counters but predicting with a copy of the wrapped models (see
+        optimization._copy_models); None when they cannot be copied
+        """
+        from approximate_equilibrium.optimize.optimization import _copy_models
+        models = _copy_models(self.models)
+        if models is None:
+            return None
+        view = copy.copy(self)
+        view.models = models
+        view._lock = self._lock
+        return view
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def predict_all(self, x_tot, columns=None):
+        """
+        Revenue predictions of every technology (or of the technologies in
+        `columns`, in that order) for each row of x_tot, shape (N, num_models)
+        """
+        x_tot = np.atleast_2d(np.asarray(x_tot, dtype=float))
+        q = np.round(x_tot / self.resolution).astype(np.int64)
+        subset = None if columns is None else [int(c) for c in columns]
+        if columns is None:
+            columns = range(len(self.models))
+            keys = [row.tobytes() for row in q]
+        else:
+            prefix = np.asarray(columns, dtype=np.int64).tobytes() + b"|"
+            keys = [prefix + row.tobytes() for row in q]
+        out = np.empty((len(keys), len(columns)))
+
+        missing = OrderedDict()
+        with self._lock:
+            for n, key in enumerate(keys):
+                y = self._entries.get(key)
+                if y is None:
+                    missing.setdefault(key, []).append(n)
+                else:
+                    self._entries.move_to_end(key)
+                    out[n] = y
+            self._owner.hits += len(keys) - len(missing)
+            self._owner.misses += len(missing)
+        if not missing:
+            return out
+
+        rows = [ns[0] for ns in missing.values()]
+        points = q[rows] * self.resolution
+        if hasattr(self.models, "predict_all"):
+            if subset is None:
+                pred = np.asarray(self.models.predict_all(points), dtype=float)
+            else:
+                pred = np.asarray(self.models.predict_all(points, columns=subset), dtype=float)
+        else:
+            pred = np.column_stack([np.asarray(self.models[ix].predict(points)).reshape(-1)
+                                    for ix in columns])
+        with self._lock:
+            for (key, ns), y in zip(missing.items(), pred):
+                out[ns] = y
+                self._entries[key] = y
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return out
@@ -0,0 +1,234 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Evaluators already built, with a checksum of the weights they were built
+# from, keyed on the evaluator class and the model objects' ids; at most
+# _MAX_BUILT are kept, see _Evaluator.for_models
+_BUILT = OrderedDict()
+_MAX_BUILT = 8
+
+_ACTIVATIONS = {
+    "relu": (lambda a: np.maximum(a, 0.), lambda a: (a > 0.).astype(a.dtype)),
+    "linear": (lambda a: a, lambda a: np.ones_like(a)),
+}
+
+
+def _weights_checksum(models):
+    """Digest of the weights of a list of Keras models or NumpyICNNs"""
+    digest = hashlib.sha1()
+    for m in models:
+        if isinstance(m, NumpyICNN):
+            weights = m.W + [w for pair in m.D for w in pair] + [m.W_out]
+        else:
+            weights = m.get_weights()
+        for w in weights:
+            digest.update(np.ascontiguousarray(w).tobytes())
+    return digest.hexdigest()
+
+
+def clear_evaluators():
+    """Drop every evaluator kept by icnn_evaluator / for_models"""
+    _BUILT.clear()
+
+
+class _Evaluator(object):
+
+    @classmethod
+    def for_models(cls, models):
+        """
+        Evaluator for `models`, reusing the one built earlier for the same
+        model objects unless their weights have changed since (e.g. after
+        retraining in place). Only the _MAX_BUILT most recent evaluators
+        are kept; clear_evaluators drops them all.
+        """
+        if isinstance(models, _Evaluator):
+            return models
+        key = (cls,) + tuple(id(m) for m in models)
+        checksum = _weights_checksum(models)
+        entry = _BUILT.get(key)
+        if entry is not None and entry[1] == checksum:
+            _BUILT.move_to_end(key)
+            return entry[0]
+        ev = cls(models)
+        _BUILT[key] = (ev, checksum)
+        _BUILT.move_to_end(key)
+        while len(_BUILT) > _MAX_BUILT:
+            _BUILT.popitem(last=False)
+        return ev
+
+    def __reduce_ex__(self, protocol):
+        # loaded from a model bank: pickle as a reference to it
+        if getattr(self, "source", None) is not None:
+            from approximate_equilibrium import modelbank
+            return modelbank._bank_models, self.source
+        return super(_Evaluator, self).__reduce_ex__(protocol)
+
+
+class ICNNEvaluator(_Evaluator):
+    """
+    Value-and-gradient evaluator for a set of Keras ICNN technology models.
+    The output and input-gradient tensors of every model are added to the
+    TensorFlow graph once, on construction, and all the models are then
+    evaluated with a single session call, so the graph does not grow with
+    the number of objective evaluations. Multi-output networks contribute
+    one entry per output.
+    """
+
+    def __init__(self, models):
+        import keras.backend as K
+        self.models = models
+        self.session = K.get_session()
+        self.inputs = [m.inputs[0] for m in models]
+        self.outputs = [m.output for m in models]
+        self.grads = [K.gradients(m.output[:, o], m.inputs)[0]
+                      for m in models for o in range(int(m.output.shape[-1]))]
+
+    def evaluate(self, x_tot):
+        """
+        Predictions of every output, shape (num_outputs,), and their gradients
+        w.r.t. the input, shape (num_outputs, input_dim), at the point x_tot
+        """
+        x_tot = np.asarray(x_tot, dtype="float32").reshape(1, -1)
+        vals = self.session.run(self.outputs + self.grads,
+                                feed_dict={u: x_tot for u in self.inputs})
+        n = len(self.outputs)
+        y = np.concatenate([v.reshape(-1) for v in vals[:n]]).astype(float)
+        grad = np.vstack([v.reshape(-1) for v in vals[n:]]).astype(float)
+        return y, grad
+
+
+class NumpyICNN(object):
+    """
+    NumPy forward/backward pass of a network built by model_icnn.icnn_model:
+    z_1 = g(u W_1), z_{k+1} = g(z_k W_{k+1}) + g(u D_{k+1} + b_{k+1}) and
+    y = g_out(z W_out). Gradients w.r.t. the input are computed in closed
+    form by a reverse pass, for a batch of inputs at once.
+    """
+
+    def __init__(self, W, D, W_out, activation="relu", output_activation="relu"):
+        self.W = [np.asarray(w, dtype=float) for w in W]
+        self.D = [(np.asarray(k, dtype=float), np.asarray(b, dtype=float)) for k, b in D]
+        self.W_out = np.asarray(W_out, dtype=float)
+        self.activation = activation
+        self.output_activation = output_activation
+
+    @classmethod
+    def from_keras(cls, model):
+        """Export the W_i, D_i and output weights of a trained Keras ICNN"""
+        layers = {layer.name: layer for layer in model.layers}
+        W = [layers["W_1"].get_weights()[0]]
+        D = []
+        n = 2
+        while "W_{}".format(n) in layers:
+            W.append(layers["W_{}".format(n)].get_weights()[0])
+            kernel, bias = layers["D_{}".format(n)].get_weights()
+            D.append((kernel, bias))
+            n += 1
+        return cls(W, D, layers["output"].get_weights()[0],
+                   activation=layers["W_1"].get_config()["activation"],
+                   output_activation=layers["output"].get_config()["activation"])
+
+    @property
+    def output_dim(self):
+        return self.W_out.shape[1]
+
+    def predict(self, u):
+        """Network output for each row of u, shape (N, output_dim)"""
+        return self._forward(u)[0]
+
+    def _forward(self, u):
+        act = _ACTIVATIONS[self.activation][0]
+        u = np.atleast_2d(np.asarray(u, dtype=float))
+        a_1 = u @ self.W[0]
+        z = act(a_1)
+        pre = []
+        for W_k, (D_k, b_k) in zip(self.W[1:], self.D):
+            a_w = z @ W_k
+            a_d = u @ D_k + b_k
+            pre.append((a_w, a_d))
+            z = act(a_w) + act(a_d)
+        a_out = z @ self.W_out
+        return _ACTIVATIONS[self.output_activation][0](a_out), (u, a_1, pre, a_out)
+
+    def value_and_gradient(self, u):
+        """
+        Network output, shape (N, output_dim), and its Jacobian w.r.t. the
+        input, shape (N, output_dim, input_dim), for each row of u
+        """
+        y, (u, a_1, pre, a_out) = self._forward(u)
+        dact = _ACTIVATIONS[self.activation][1]
+        d_out = _ACTIVATIONS[self.output_activation][1](a_out)
+        layers = list(zip(self.W[1:], self.D, pre))[::-1]
+        jac = np.empty((u.shape[0], self.output_dim, u.shape[1]))
+        for o in range(self.output_dim):
+            g_z = d_out[:, [o]] * self.W_out[:, o]
+            g_u = np.zeros_like(u)
+            for W_k, (D_k, b_k), (a_w, a_d) in layers:
+                g_u += (g_z * dact(a_d)) @ D_k.T
+                g_z = (g_z * dact(a_w)) @ W_k.T
+            g_u += (g_z * dact(a_1)) @ self.W[0].T
+            jac[:, o, :] = g_u
+        return y, jac
+
+
+class NumpyICNNEvaluator(_Evaluator):
+    """
+    Drop-in replacement for ICNNEvaluator that runs NumpyICNN exports of the
+    models instead of TensorFlow. Multi-output networks contribute one entry
+    per output.
+    """
+
+    # pure NumPy, safe to call from several threads
+    thread_safe = True
+
+    def __init__(self, models):
+        self.models = models
+        self.nets = [m if isinstance(m, NumpyICNN) else NumpyICNN.from_keras(m) for m in models]
+
+    def __len__(self):
+        return sum(net.output_dim for net in self.nets)
+
+    def predict_all(self, x_tot, columns=None):
+        """Predictions of every output (or those in `columns`) for each row of x_tot, shape (N, num_outputs)"""
+        pred = np.hstack([net.predict(x_tot) for net in self.nets])
+        return pred if columns is None else pred[:, columns]
+
+    def evaluate(self, x_tot):
+        """
+        Predictions of every output, shape (num_outputs,), and their gradients
+        w.r.t. the input, shape (num_outputs, input_dim), at the point x_tot
+        """
+        x_tot = np.asarray(x_tot, dtype=float).reshape(1, -1)
+        ys, grads = [], []
+        for net in self.nets:
+            y, jac = net.value_and_gradient(x_tot)
+            ys.append(y[0])
+            grads.append(jac[0])
+        return np.concatenate(ys), np.vstack(grads)
+
+
+_BACKENDS = {"keras": ICNNEvaluator, "numpy": NumpyICNNEvaluator}
+
+
+def icnn_evaluator(models, backend="numpy"):
+    """Cached value-and-gradient evaluator for `models` on the given backend"""
+    return _BACKENDS[backend].for_models(models)
+
+
+def icnn_parity(models, x):
+    """
+    Largest absolute differences between the Keras and NumPy evaluations
+    of `models` (predictions and input gradients) over the rows of x
+    """
+    keras_ev = ICNNEvaluator.for_models(models)
+    numpy_ev = NumpyICNNEvaluator.for_models(models)
+    err_y, err_grad = 0., 0.
+    for row in np.atleast_2d(x):
+        y_k, g_k = keras_ev.evaluate(row)
+        y_n, g_n = numpy_ev.evaluate(row)
+        err_y = max(err_y, np.abs(y_k - y_n).max())
+        err_grad = max(err_grad, np.abs(g_k - g_n).max())
+    return {"prediction": err_y, "gradient": err_grad}
@@ -1,28 +1,43 @@
+import copy
 import os
 import glob
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+import logging
 import pickle
+import queue
+import threading
+import time
 
-from mpl_toolkits.mplot3d import Axes3D
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
-import seaborn as sns
 
-from scipy.optimize import Bounds, minimize, differential_evolution, brute, fmin
-from scipy.stats import uniform
-import keras.backend as K
-import xgboost as XGB
+from scipy.optimize import Bounds, minimize, differential_evolution, fmin
 
+from approximate_equilibrium.optimize.icnn import icnn_evaluator
+from approximate_equilibrium.instrument import LatencyTimer
 
-def objective_function(x_i, x_i_prev, x_ineg, capcosts, MODELS, regularize=False, alpha=1.):
+
+logger = logging.getLogger(__name__)
+
+# Held around predict calls on models the restart threads cannot copy, see _model_pool
+_PREDICT_LOCK = threading.RLock()
+
+
+def objective_function(x_i, x_i_prev, x_ineg, capcosts, MODELS, regularize=False, alpha=1., columns=None):
+    if columns is not None:
+        return objective_function_batch(x_i, x_i_prev, x_ineg, capcosts, MODELS, regularize, alpha,
+                                        columns)[0]
     x_i = x_i.reshape(-1, len(capcosts))   # investor
     x_tot = (x_i + x_ineg).reshape(-1, len(capcosts))
+    # Model sets such as PredictionCache return every technology in one call
+    rev = MODELS.predict_all(x_tot)[0] if hasattr(MODELS, "predict_all") else None
     y = 0.
-    for ix, model in enumerate(MODELS):
+    for ix in range(len(MODELS)):
         if x_tot[0, ix] == 0.0:
             continue
-        net_rev = model.predict(x_tot).squeeze() * (x_i[0, ix]/x_tot[0, ix])
+        pred = MODELS[ix].predict(x_tot).squeeze() if rev is None else rev[ix]
+        net_rev = pred * (x_i[0, ix]/x_tot[0, ix])
         total_cost = capcosts[ix].squeeze() * x_i[0, ix].squeeze()
         y += total_cost - net_rev
     if regularize is True:
@@ -30,115 +45,566 @@ def objective_function(x_i, x_i_prev, x_ineg, capcosts, MODELS, regularize=False
     return y
 
 
-def objective_function_iccn(u, x_ineg, capcosts, datastruct, models, g):
+def objective_function_batch(X_i, x_i_prev, x_ineg, capcosts, MODELS, regularize=False, alpha=1.,
+                             columns=None):
+    """
+    Population-wide version of objective_function. X_i is an (N, num_gens)
+    matrix of candidate decisions, every model is called once on the
+    corresponding total capacities and the N objective values are returned.
+
+    With `columns` (the technologies the agent owns), X_i and x_i_prev
+    hold only those columns, the other technologies stay at x_ineg and
+    only the models of `columns` are evaluated.
+    """
+    x_ineg = np.asarray(x_ineg, dtype=float).reshape(1, -1)
+    if columns is None:
+        cols = range(len(capcosts))
+        X_i = np.asarray(X_i, dtype=float).reshape(-1, len(capcosts))
+        x_tot = X_i + x_ineg
+        rev = MODELS.predict_all(x_tot) if hasattr(MODELS, "predict_all") else None
+    else:
+        cols = columns
+        X_i = np.asarray(X_i, dtype=float).reshape(-1, len(columns))
+        x_tot = np.repeat(x_ineg, X_i.shape[0], axis=0)
+        x_tot[:, columns] += X_i
+        rev = MODELS.predict_all(x_tot, columns=columns) if hasattr(MODELS, "predict_all") else None
+    y = np.zeros(X_i.shape[0])
+    for k, ix in enumerate(cols):
+        active = x_tot[:, ix] != 0.0
+        if not active.any():
+            continue
+        if rev is None:
+            pred = np.asarray(MODELS[ix].predict(x_tot[active])).reshape(-1)
+        else:
+            pred = rev[active, k]
+        net_rev = pred * (X_i[active, k]/x_tot[active, ix])
+        total_cost = capcosts[ix].squeeze() * X_i[active, k]
+        y[active] += total_cost - net_rev
+    if regularize is True:
+        y += alpha * ((X_i - np.asarray(x_i_prev).reshape(1, -1))**2).sum(axis=1)
+    return y
+
+
+class _PopulationMap(object):
+    """
+    Map-like callable handed to differential_evolution as `workers`. With
+    deferred updating scipy evaluates each population through it, so the
+    members are stacked and scored by objective_function_batch in one call
+    (or one by one with batch=False). It also counts the evaluations and
+    keeps the n_elite best members seen, for warm-starting the next solve.
+    """
+
+    def __init__(self, args, batch=True, n_elite=0):
+        self.args = args
+        self.batch = batch
+        self.n_elite = n_elite
+        self.nfev = 0
+        self.elite = None
+        self.elite_f = None
+
+    def track(self, func):
+        """
+        func, scoring one member at a time, with the evaluations counted and
+        kept for the elite; for scipy's default (immediate) updating
+        """
+        def tracked(member, *args):
+            y = func(member, *args)
+            self.nfev += 1
+            if self.n_elite > 0:
+                self._keep_elite(np.atleast_2d(member), np.array([y]))
+            return y
+        return tracked
+
+    def __call__(self, func, iterable):
+        X = np.array(list(iterable))
+        if X.size == 0:
+            return []
+        if self.batch:
+            y = objective_function_batch(X, *self.args)
+        else:
+            y = np.array([func(member) for member in X])
+        self.nfev += len(X)
+        if self.n_elite > 0:
+            self._keep_elite(X, y)
+        return y
+
+    def _keep_elite(self, X, y):
+        if self.elite is not None:
+            X = np.vstack([self.elite, X])
+            y = np.concatenate([self.elite_f, y])
+        keep = np.argsort(y, kind="stable")[:self.n_elite]
+        self.elite, self.elite_f = X[keep], y[keep]
+
+
+def _seed_population(elite, lower_bound, upper_bound, size, seed=None):
+    """
+    Initial DE population of `size` members: the previous elite members
+    clipped to the current bounds, topped up with a Latin hypercube sample
+    """
+    members = np.clip(elite[:size], lower_bound, upper_bound)
+    n_fill = size - len(members)
+    if n_fill <= 0:
+        return members
+    rng = np.random.RandomState(seed)
+    strata = np.column_stack([rng.permutation(n_fill) for _ in range(len(lower_bound))])
+    fill = lower_bound + (strata + rng.rand(n_fill, len(lower_bound))) / n_fill * (upper_bound - lower_bound)
+    return np.vstack([members, fill])
+
+
+def _locked(func):
+    def call(*args, **kwargs):
+        with _PREDICT_LOCK:
+            return func(*args, **kwargs)
+    return call
+
+
+class _SerializedModel(object):
+
+    def __init__(self, model):
+        self.model = model
+        self.predict = _locked(model.predict)
+
+
+class _SerializedModels(object):
+    """Model set whose predict / predict_all calls are made one at a time"""
+
+    def __init__(self, models):
+        self.models = models
+        if hasattr(models, "predict_all"):
+            self.predict_all = _locked(models.predict_all)
+
+    def __len__(self):
+        return len(self.models)
+
+    def __getitem__(self, ix):
+        return _SerializedModel(self.models[ix])
+
+
+def _copy_models(models):
+    """
+    `models` for use from one more thread: sets that declare `thread_safe`
+    (CompiledTreeEnsemble, NumpyICNNEvaluator) are shared, lists of XGBoost
+    models are deep-copied (a booster is only safe to predict from one
+    thread at a time) and sets with a thread_copy method (PredictionCache)
+    make their own. None when no copy can be made, e.g. for Keras models.
+    """
+    if getattr(models, "thread_safe", False):
+        return models
+    if isinstance(models, (list, tuple)) and all(hasattr(m, "get_booster") for m in models):
+        return [copy.deepcopy(m) for m in models]
+    if hasattr(models, "thread_copy"):
+        return models.thread_copy()
+    return None
+
+
+class _ModelPool(object):
+    """Model sets handed out to the restart threads, one per running restart"""
+
+    def __init__(self, copies):
+        self._free = queue.Queue()
+        for models in copies:
+            self._free.put(models)
+
+    @contextmanager
+    def take(self):
+        models = self._free.get()
+        try:
+            yield models
+        finally:
+            self._free.put(models)
+
+
+def _model_pool(models, n_jobs):
+    """
+    Model sets for n_jobs restart threads: `models` itself and n_jobs - 1
+    copies (see _copy_models), so that the threads predict concurrently.
+    Sets that cannot be copied are shared with their predict calls
+    serialized behind a lock.
+    """
+    copies = [models]
+    for _ in range(n_jobs - 1):
+        other = _copy_models(models)
+        if other is None:
+            return _ModelPool([_SerializedModels(models)] * n_jobs)
+        copies.append(other)
+    return _ModelPool(copies)
+
+
+def _restart_seeds(seed, num_x0):
+    """Independent seeds for each restart, derived from seed (all None without one)"""
+    if seed is None:
+        return [None] * num_x0
+    return [int(ss.generate_state(1)[0]) for ss in np.random.SeedSequence(seed).spawn(num_x0)]
+
+
+def _run_restarts(solve, num_x0, seed=None, n_jobs=1, cancel_tol=None):
+    """
+    Run num_x0 independent restarts of solve(seed, stop), each returning
+    (fun, x), and return their values and solutions in restart order.
+    With n_jobs > 1 the restarts run concurrently on a thread pool (the
+    callers give each running restart its own models, see _model_pool). With
+    cancel_tol set, once a restart finishes within cancel_tol of the best
+    value found so far the pending restarts are cancelled and the running
+    ones are asked to stop through the `stop` event.
+    """
+    seeds = _restart_seeds(seed, num_x0)
+    stop = threading.Event()
+    results = []
+
+    def finish(j, res):
+        fun = res[0]
+        converged = (cancel_tol is not None and len(results) > 0
+                     and abs(fun - min(r[1] for r in results)) <= cancel_tol)
+        results.append((j, fun, res[1]))
+        return converged
+
+    if n_jobs > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            futures = {pool.submit(solve, s, stop): j for j, s in enumerate(seeds)}
+            for fut in as_completed(futures):
+                if fut.cancelled():
+                    continue
+                if finish(futures[fut], fut.result()):
+                    stop.set()
+                    for other in futures:
+                        other.cancel()
+    else:
+        for j, s in enumerate(seeds):
+            if finish(j, solve(s, stop)):
+                break
+
+    results.sort(key=lambda r: r[0])
+    fs = np.array([r[1] for r in results])
+    xs = np.array([r[2] for r in results])
+    return fs, xs
+
+
+def objective_function_iccn(u, x_ineg, capcosts, datastruct, models, g=None):
     """
     Returns the value of the ICNN and gradient of output w.r.t. input 
-    evaluated at a given input tensor
+    evaluated at a given input tensor. `models` may be a list of Keras
+    models, evaluated through their NumPy export, or an ICNNEvaluator /
+    NumpyICNNEvaluator; `g` is no longer used.
     """
-    # Generate output
-    y =0.
+    evaluator = icnn_evaluator(models)
     x_tot = (u + x_ineg).reshape(1,len(capcosts))
-    grad = np.zeros((1,len(capcosts)), dtype=float)
-    for ix, m in enumerate(models):
-        y += m.predict(x_tot).squeeze()
-        # Get gradient of output w.r.t. inputs.  
-        sess = K.get_session()
-        _grad = sess.run(g[ix], feed_dict={m.inputs[0]: x_tot})[0].squeeze()
-        if (x_tot == np.zeros((1,len(capcosts)))).all():
-            grad +=  _grad
-        else:
-            grad +=  +_grad*(u/x_tot) + ((x_tot-u)/x_tot**2) * m.predict(x_tot).squeeze()
+    preds, grads = evaluator.evaluate(x_tot)
+    y = preds.sum()
+    if (x_tot == np.zeros((1,len(capcosts)))).all():
+        grad = grads.sum(axis=0)
+    else:
+        grad = (grads*(u/x_tot)).sum(axis=0) + ((x_tot-u)/x_tot**2) * y
 
-    return np.float(y), grad.reshape(len(capcosts))
+    return float(y), grad.reshape(len(capcosts))
 
 
-def de_optimizer(x, i, nodes, capcosts, caplimits, datastruct,
-                models, iteration_count, action_incr=np.inf, num_x0=5,
-                regularize=False, alpha=1.):
-    """Optimize for agent i"""
-    
-    # Get total upper and lower bounds
-    nodes = np.array(nodes)
-    lower_bound_tot = nodes.min(axis=0)
-    upper_bound_tot = nodes.max(axis=0)
-    
-    # Get upper and lower bounds for agent based on other agents' decisions
+def _agent_bounds(x, i, nodes, caplimits, action_incr=np.inf, x_ineg=None):
+    """
+    Competitors of agent i, their aggregate decision x_ineg (unless given)
+    and the box agent i searches: from zero up to the room left under the
+    largest sampled capacity, within action_incr of its current decision
+    and within its capacity limits
+    """
+    upper_bound_tot = np.array(nodes).max(axis=0)
     ineg = [x for x in range(x.shape[0]) if x != i]
-    x_ineg = x[ineg, :].sum(axis=0)
-    lower_bound = np.zeros_like(lower_bound_tot)
+    if x_ineg is None:
+        x_ineg = x[ineg, :].sum(axis=0)
+    lower_bound = np.zeros_like(upper_bound_tot)
     upper_bound = np.clip(upper_bound_tot - x_ineg, 0, upper_bound_tot)
     upper_bound = np.minimum(upper_bound, x[i, :] + action_incr)
     upper_bound = np.minimum(upper_bound, caplimits)
+    return ineg, x_ineg, lower_bound, upper_bound
+
+
+def _expand(x_owned, columns, num_gens):
+    """Full-length decision with x_owned in `columns` and zero elsewhere"""
+    x = np.zeros(num_gens)
+    x[columns] = x_owned
+    return x
+
+
+def de_optimizer(x, i, nodes, capcosts, caplimits, datastruct,
+                models, iteration_count, action_incr=np.inf, num_x0=5,
+                regularize=False, alpha=1., batch=True, seed=None, n_jobs=1,
+                cancel_tol=None, warm_start=None, warm_fraction=0.5, stats=None, columns=None,
+                x_ineg=None):
+    """
+    Optimize for agent i. With batch=True each DE population is evaluated
+    by objective_function_batch (one predict call per model per generation)
+    instead of calling objective_function once per member. Passing a seed
+    makes the restarts reproducible; n_jobs and cancel_tol are handed to
+    _run_restarts.
+
+    warm_start is a dict kept by the caller between solves of this agent.
+    The best warm_fraction of a population seen in this solve is stored in
+    it under "population" and seeds the initial population of the next
+    solve, clipped to the new bounds. The solve's function evaluations and
+    generations are stored under "nfev" and "nit". scipy cannot seed a
+    population over zero-width bounds (a zero capacity limit, or a
+    competitors' total already at the sampled maximum), so a warm-started
+    solve searches the other dimensions only and pins those at zero; their
+    number is stored under "pinned", and "seeded" tells whether the
+    population was seeded at all. With batch=False the members are still
+    scored one at a time with scipy's immediate updating.
+
+    With a stats dict, the solve's wall time, evaluations, generations,
+    termination messages and surrogate predict latencies are written to
+    it (see instrument.summarize).
+
+    With n_jobs > 1, every running restart predicts with its own copy of
+    models that are not thread-safe, see _model_pool.
+
+    With `columns`, the technologies agent i owns, the search runs over
+    those columns only (the rest of its decision stays at zero); the
+    warm-start population is then kept over the same columns. x_ineg
+    can be passed when the caller already keeps the competitors' total.
+    """
+    tic = time.perf_counter()
+    pool = _model_pool(models, n_jobs)
+    if stats is not None:
+        timer = LatencyTimer()
+
+    ineg, x_ineg, lower_bound, upper_bound = _agent_bounds(x, i, nodes, caplimits, action_incr, x_ineg)
+    x_i = x[i, :]
+    if columns is not None:
+        x_i, lower_bound, upper_bound = x_i[columns], lower_bound[columns], upper_bound[columns]
+    logger.debug("i: %s, ineg: %s, bounds: %s - %s", i, ineg, lower_bound, upper_bound)
+
+    search, free, penalty = columns, None, 0.
+    if warm_start is not None:
+        # pin zero-width dimensions (at their bound, zero) out of the search;
+        # the warm-start population is kept over all of them
+        free = upper_bound > lower_bound
+        if free.any() and not free.all():
+            search = (np.arange(len(x_ineg)) if columns is None else np.asarray(columns))[free]
+            if regularize:
+                penalty = alpha * (x_i[~free]**2).sum()
+            x_i, lower_bound, upper_bound = x_i[free], lower_bound[free], upper_bound[free]
+        elif not free.any():
+            free = None
     bounds = Bounds(lower_bound, upper_bound)
-    print("i: {}, ineg: {}".format(i, ineg))
-    print("   lower_bound: {}".format(lower_bound))
-    print("   upper_bound: {}".format(upper_bound))
 
     # Solve over random starting points
-    fs= []; xs = []
-    for j in range(num_x0):
-        res = differential_evolution(objective_function, 
-                                     bounds=bounds,
-                                     args=(x[i, :], x_ineg, capcosts, models, regularize, alpha),
-                                     popsize=100,
-                                     mutation=0.5,
-                                     recombination=0.9,
-                                     init="latinhypercube")
-        fs.append(res["fun"])
-        xs.append(res["x"])
-    
+    popsize = 100
+    pop_members = max(5, popsize * len(lower_bound))
+    n_elite = int(warm_fraction * pop_members) if warm_start is not None else 0
+    previous = warm_start.get("population") if warm_start is not None else None
+    if previous is not None and (free is None or previous.shape[1] != len(free)):
+        previous = None
+    elif previous is not None:
+        previous = previous[:, free]
+    maps = []
+
+    def solve(seed, stop):
+        with pool.take() as restart_models:
+            if stats is not None:
+                restart_models = timer.wrap_models(restart_models)
+            args = (x_i, x_ineg, capcosts, restart_models, regularize, alpha, search)
+            de_kwargs = {}
+            func = objective_function
+            if batch or warm_start is not None:
+                maps.append(_PopulationMap(args, batch, n_elite))
+                if batch:
+                    de_kwargs = {"workers": maps[-1], "updating": "deferred"}
+                else:
+                    func = maps[-1].track(objective_function)
+            if previous is not None:
+                init = _seed_population(previous, lower_bound, upper_bound, pop_members, seed)
+            else:
+                init = "latinhypercube"
+            res = differential_evolution(func,
+                                         bounds=bounds,
+                                         args=args,
+                                         popsize=popsize,
+                                         mutation=0.5,
+                                         recombination=0.9,
+                                         init=init,
+                                         seed=seed,
+                                         callback=lambda xk, convergence: stop.is_set(),
+                                         **de_kwargs)
+        runs.append((res["nfev"], res["nit"], res["message"]))
+        return res["fun"], res["x"]
+
+    runs = []
+    fs, xs = _run_restarts(solve, num_x0, seed, n_jobs, cancel_tol)
+    if free is not None and search is not columns:
+        full = np.zeros((len(xs), len(free)))
+        full[:, free] = xs
+        xs, fs = full, fs + penalty
+    if warm_start is not None:
+        elite = [m for m in maps if m.elite is not None]
+        if elite and free is not None:
+            X = np.vstack([m.elite for m in elite])
+            y = np.concatenate([m.elite_f for m in elite])
+            population = np.zeros((len(X), len(free)))
+            population[:, free] = X
+            warm_start["population"] = population[np.argsort(y, kind="stable")[:n_elite]]
+        warm_start["nfev"] = int(sum(r[0] for r in runs))
+        warm_start["nit"] = int(sum(r[1] for r in runs))
+        warm_start["pinned"] = 0 if free is None else int((~free).sum())
+        warm_start["seeded"] = previous is not None
 
     # Find the best solution
-    fs = -1 * np.array(fs)
+    fs = -1 * fs
     max_idx = np.argmax(fs)
 
-    xs = np.array(xs)
-
     xopt = xs[max_idx]
     fopt = fs[max_idx]
+    if columns is not None:
+        xopt = _expand(xopt, columns, len(x_ineg))
+    logger.debug("  xopt: %s, fopt: %s", xopt, fopt)
 
-    print("  xopt: {}".format(xopt))
-    print("  fopt: {}".format(fopt))
+    if stats is not None:
+        stats.update(optimizer="de", wall_time=time.perf_counter() - tic,
+                     nfev=int(sum(r[0] for r in runs)), njev=0, nit=int(sum(r[1] for r in runs)),
+                     restarts=len(runs), status="; ".join(sorted(set(r[2] for r in runs))),
+                     predict_latency=timer.latencies)
+        if warm_start is not None:
+            stats.update(warm_seeded=warm_start["seeded"], pinned=warm_start["pinned"])
     
     return xopt, fopt
 
+def _grid_points(lower, upper, points, max_points, rng):
+    """
+    Lattice of `points` values per dimension over [lower, upper] (one value
+    along zero-width dimensions) as a generator of index chunks, the
+    spacing of the lattice and the number of points it yields. Lattices
+    larger than max_points are replaced by max_points random lattice nodes.
+    """
+    counts = np.where(upper > lower, points, 1)
+    step = np.where(counts > 1, (upper - lower) / np.maximum(counts - 1, 1), 0.)
+    total = 1
+    for c in counts:
+        total *= int(c)
+    full = total <= max_points
+    size = total if full else max_points
+
+    def chunks(chunk_size):
+        for start in range(0, size, chunk_size):
+            n = min(chunk_size, size - start)
+            if full:
+                idx = np.column_stack(np.unravel_index(np.arange(start, start + n), counts))
+            else:
+                idx = rng.randint(0, counts, size=(n, len(counts)))
+            yield lower + idx * step
+
+    return chunks, step, size
+
+
+def _max_slope(X, y):
+    """Largest |f(a) - f(b)| / |a - b| between consecutive rows of X"""
+    if len(X) < 2:
+        return 0.
+    dist = np.linalg.norm(np.diff(X, axis=0), axis=1)
+    ok = dist > 0
+    if not ok.any():
+        return 0.
+    return float((np.abs(np.diff(y))[ok] / dist[ok]).max())
+
+
+def grid_optimizer(x, i, nodes, capcosts, caplimits, datastruct,
+                   models, iteration_count, action_incr=np.inf, points=5, levels=4,
+                   top_k=3, max_points=100000, chunk_size=10000, lipschitz=None, slope_safety=2.,
+                   regularize=False, alpha=1., seed=None, stats=None, columns=None, x_ineg=None):
+    """
+    Coarse-to-fine grid search for agent i, for any number of technologies.
+    Each level lays a lattice of `points` values per technology over every
+    cell still in play and scores it with objective_function_batch in
+    chunks of chunk_size rows, so memory does not grow with the lattice.
+    Lattices over max_points are sampled at max_points random nodes. The
+    top_k best points of a level become the next level's cells, one
+    lattice spacing either side of them, so the resolution shrinks by a
+    factor (points - 1) / 2 per level.
+
+    With `lipschitz`, a Lipschitz constant L of the objective, a cell
+    centred on a point with value f and half-widths h is pruned when
+    f - L |h| exceeds the incumbent, which it then cannot improve on. No
+    cell is pruned when lipschitz is None. lipschitz="estimate" uses the
+    steepest slope seen between consecutive lattice points times
+    slope_safety instead: a heuristic that can prune the optimum. Returns xopt and fopt like de_optimizer; columns and x_ineg
+    restrict the search to the technologies agent i owns, as there.
+    """
+    tic = time.perf_counter()
+    if stats is not None:
+        timer = LatencyTimer()
+        models = timer.wrap_models(models)
+    rng = np.random.RandomState(seed)
+
+    ineg, x_ineg, lower_bound, upper_bound = _agent_bounds(x, i, nodes, caplimits, action_incr, x_ineg)
+    x_i = x[i, :]
+    if columns is not None:
+        x_i, lower_bound, upper_bound = x_i[columns], lower_bound[columns], upper_bound[columns]
+    logger.debug("i: %s, ineg: %s, bounds: %s - %s", i, ineg, lower_bound, upper_bound)
+    args = (x_i, x_ineg, capcosts, models, regularize, alpha, columns)
+
+    best_x, best_f = lower_bound.copy(), np.inf
+    estimate = isinstance(lipschitz, str)
+    if estimate and lipschitz != "estimate":
+        raise ValueError("lipschitz must be a number, None or 'estimate'")
+    slope = 0. if estimate else lipschitz
+    cells = [(np.inf, lower_bound, upper_bound, None, None)]
+    nfev, pruned, level = 0, 0, 0
+    for level in range(levels):
+        candidates = []
+        for f_centre, lo, hi, centre, half in cells:
+            if (centre is not None and slope is not None
+                    and f_centre - slope * np.linalg.norm(half) > best_f):
+                pruned += 1
+                continue
+            chunks, step, _ = _grid_points(lo, hi, points, max_points, rng)
+            for X in chunks(chunk_size):
+                y = objective_function_batch(X, *args)
+                nfev += len(X)
+                if estimate:
+                    slope = max(slope, slope_safety * _max_slope(X, y))
+                keep = np.argsort(y, kind="stable")[:top_k]
+                candidates.extend((y[k], X[k], step) for k in keep)
+                if y[keep[0]] < best_f:
+                    best_f, best_x = y[keep[0]], X[keep[0]].copy()
+        if not candidates or not np.any([c[2].max() > 0 for c in candidates]):
+            break
+        candidates.sort(key=lambda c: c[0])
+        cells = [(f, np.maximum(lower_bound, p - h), np.minimum(upper_bound, p + h), p, h)
+                 for f, p, h in candidates[:top_k]]
+
+    xopt, fopt = best_x, -best_f
+    if columns is not None:
+        xopt = _expand(xopt, columns, len(x_ineg))
+    logger.debug("  xopt: %s, fopt: %s", xopt, fopt)
+    if stats is not None:
+        stats.update(optimizer="grid", wall_time=time.perf_counter() - tic, nfev=int(nfev), njev=0,
+                     nit=level + 1, restarts=1, status="{} cells pruned".format(pruned),
+                     predict_latency=timer.latencies)
+    return xopt, fopt
+
+
 def brute_force_optimizer(x, i, nodes, capcosts, caplimits, datastruct,
                             models, iteration_count, action_incr=np.inf, num_x0=10, 
-                            regularize=False, alpha=1.):
-
-    # Get total upper and lower bounds
-    nodes = np.array(nodes)
-    lower_bound_tot = nodes.min(axis=0)
-    upper_bound_tot = nodes.max(axis=0)
-    
-    # Get upper and lower bounds for agent based on other agents' decisions
-    ineg = [x for x in range(x.shape[0]) if x != i]
-    x_ineg = x[ineg, :].sum(axis=0)
-    lower_bound = np.zeros_like(lower_bound_tot)
-#     lower_bound = np.clip(lower_bound_tot, 0, upper_bound_tot)
-    upper_bound = np.clip(upper_bound_tot, 0, upper_bound_tot)
-    upper_bound = np.minimum(upper_bound, x[i, :] + action_incr)
-    upper_bound = np.maximum(upper_bound, caplimits)
-    bounds = Bounds(lower_bound, upper_bound)
-    print("i: {}, ineg: {}".format(i, ineg))
-    print("   lower_bound: {}".format(lower_bound))
-    print("   upper_bound: {}".format(upper_bound))
-    print(x[i, :])
-    split_array = [3, 4, 2, 3, 0.5, 4, 4]
-    ranges = tuple([slice(lower_bound[i], upper_bound[i], split_array[i]) for i in range(0,7)])
-    xv, f, _, _ = brute(objective_function, ranges=ranges,  
-                    args=(x[i, :], x_ineg, capcosts, models, 
-                            regularize, alpha), 
-                    finish=None, full_output=True)
-    print(" BFO xopt: ",(xv))
-    print(" BFO fopt: ",(f))
-    return xv, f
+                            regularize=False, alpha=1., stats=None, **grid_options):
+    """
+    Global grid search for agent i, see grid_optimizer (grid_options are
+    handed to it): the num_x0 best points of each level are refined (its
+    top_k), and no cell is pruned unless a lipschitz constant is given.
+    Returns the decision and its objective value.
+    """
+    grid_options.setdefault("top_k", num_x0)
+    xv, f = grid_optimizer(x, i, nodes, capcosts, caplimits, datastruct, models, iteration_count,
+                           action_incr=action_incr, regularize=regularize, alpha=alpha,
+                           stats=stats, **grid_options)
+    return xv, -f
 
 
 def gradient_optimizer(x, i, nodes, capcosts, caplimits, datastruct,
                 models, iteration_count, action_incr=np.inf, num_x0=3,
-                regularize=False, alpha=1.):
-    """Optimize for agent i"""
+                regularize=False, alpha=1., seed=None, n_jobs=1, cancel_tol=None,
+                backend="numpy", stats=None):
+    """
+    Optimize for agent i; n_jobs and cancel_tol are handed to _run_restarts.
+    backend="numpy" evaluates the ICNNs with NumpyICNN, "keras" runs them
+    through the TensorFlow session, whose calls are serialized when the
+    restarts run on several threads. stats is filled as in de_optimizer.
+    """
+    tic = time.perf_counter()
     
     # Get total upper and lower bounds
     nodes = np.array(nodes)
@@ -153,38 +619,48 @@ def gradient_optimizer(x, i, nodes, capcosts, caplimits, datastruct,
     lower_bound = np.clip(lower_bound_tot - x_ineg, 0, lower_bound)
     upper_bound = np.clip(upper_bound_tot - x_ineg, 0, upper_bound_tot)
     bounds = Bounds(lower_bound, upper_bound)
-    grads = [K.gradients(model.output, model.inputs) for model in models]
-    print("i: {}, ineg: {}".format(i, ineg))
-    print("   lower_bound: {}".format(lower_bound))
-    print("   upper_bound: {}".format(upper_bound))
+    evaluator = icnn_evaluator(models, backend)
+    if n_jobs > 1 and not getattr(evaluator, "thread_safe", False):
+        evaluator = copy.copy(evaluator)
+        evaluator.evaluate = _locked(evaluator.evaluate)
+    if stats is not None:
+        timer = LatencyTimer()
+        evaluator = copy.copy(evaluator)
+        evaluator.evaluate = timer.wrap(evaluator.evaluate)
+    logger.debug("i: %s, ineg: %s, bounds: %s - %s", i, ineg, lower_bound, upper_bound)
     # Solve over random starting points
-    fs= []; xs = []
-    for j in range(num_x0):
+    def solve(seed, stop):
+        # unseeded runs draw from the global state, so np.random.seed reproduces them
+        rng = np.random.RandomState(seed) if seed is not None else np.random
         if all(x[i, :] == 0.0):
-            int_start = np.random.rand(len(lower_bound))*np.array([1, 1, 1, 1, 1e-5, 1, 1])
+            int_start = rng.rand(len(lower_bound))*np.array([1, 1, 1, 1, 1e-5, 1, 1])
         else:
-            int_start = x[i, :] + np.random.rand(len(lower_bound))*np.array([0.1, 0.1, 0.1, 0.1, 0.0, 0.1, 0.1])/iteration_count
+            int_start = x[i, :] + rng.rand(len(lower_bound))*np.array([0.1, 0.1, 0.1, 0.1, 0.0, 0.1, 0.1])/iteration_count
         res = minimize(objective_function_iccn,
                         x0=int_start,
                         bounds=bounds,
-                        args=(x_ineg, capcosts, datastruct, models, grads),
+                        args=(x_ineg, capcosts, datastruct, evaluator),
                         method="trust-constr",
                         jac=True, 
+                        callback=lambda xk, state: stop.is_set(),
                         options={ 'disp': False, 'maxiter': 10000}, tol=1e-6)
-        fs.append(res["fun"])
-        xs.append(res["x"])
-    
+        runs.append((res["nfev"], res["njev"], res["nit"], res["message"]))
+        return res["fun"], res["x"]
+
+    runs = []
+    fs, xs = _run_restarts(solve, num_x0, seed, n_jobs, cancel_tol)
 
     # Find the best solution
-    fs = np.array(fs)
     max_idx = np.argmin(fs)
 
-    xs = np.array(xs)
-
     xopt = xs[max_idx]
     fopt = fs[max_idx]
+    logger.debug("  xopt: %s, fopt: %s", xopt, fopt)
 
-    print("  xopt: {}".format(xopt))
-    print("  fopt: {}".format(fopt))
+    if stats is not None:
+        stats.update(optimizer="gradient", wall_time=time.perf_counter() - tic,
+                     nfev=int(sum(r[0] for r in runs)), njev=int(sum(r[1] for r in runs)),
+                     nit=int(sum(r[2] for r in runs)), restarts=len(runs),
+                     status="; ".join(sorted(set(r[3] for r in runs))), predict_latency=timer.latencies)
     
     return xopt, fopt
\ No newline at end of file
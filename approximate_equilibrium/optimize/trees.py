@@ -0,0 +1,203 @@
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+
+def _booster_json(booster):
+    """The booster's JSON model document (trees as flat arrays, exact floats)"""
+    try:
+        raw = booster.save_raw("json")
+    except TypeError:
+        # older xgboost only writes JSON through save_model
+        fd, path = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        try:
+            booster.save_model(path)
+            with open(path, "rb") as f:
+                raw = f.read()
+        finally:
+            os.remove(path)
+    return json.loads(bytes(raw).decode())
+
+
+def _num_trees(model):
+    """Trees used by model.predict, honouring early stopping"""
+    limit = getattr(model, "best_ntree_limit", None)
+    if limit is None:
+        best = getattr(model, "best_iteration", None)
+        if best is not None:
+            limit = best + 1
+    return limit
+
+
+def _tree_depth(left, right):
+    depth, level = 0, [0]
+    while True:
+        level = [c for n in level for c in (left[n], right[n]) if c != -1]
+        if not level:
+            return depth
+        depth += 1
+
+
+def _fill_complete(tree, depth, feature, threshold, default_left, value):
+    """
+    Write an XGBoost JSON tree into complete-binary-tree arrays of the given
+    depth: internal node k has children 2k+1 and 2k+2, and leaf l sits after
+    the 2**depth - 1 internal nodes. Leaves above the bottom level become
+    pass-through nodes (threshold +inf, missing goes left) whose subtrees all
+    hold the leaf value.
+    """
+    lc, rc = tree["left_children"], tree["right_children"]
+    n_internal = 2**depth - 1
+    stack = [(0, 0, 0)]
+    while stack:
+        node, pos, level = stack.pop()
+        if level == depth:
+            value[pos - n_internal] = tree["split_conditions"][node]
+            continue
+        if lc[node] == -1:
+            feature[pos], threshold[pos], default_left[pos] = 0, np.inf, True
+            children = (node, node)
+        else:
+            feature[pos] = tree["split_indices"][node]
+            threshold[pos] = tree["split_conditions"][node]
+            default_left[pos] = bool(tree["default_left"][node])
+            children = (lc[node], rc[node])
+        stack.append((children[0], 2*pos + 1, level + 1))
+        stack.append((children[1], 2*pos + 2, level + 1))
+
+
+class CompiledTreeEnsemble(object):
+    """
+    Array-backed export of the per-technology XGBRegressor models. Every
+    tree of every model is padded to a complete binary tree of depth
+    max_depth and stored as a row of flat arrays: split features,
+    thresholds and default directions of shape (num_trees, 2**max_depth - 1)
+    and leaf values of shape (num_trees, 2**max_depth). Trees of model m are
+    rows tree_offsets[m]:tree_offsets[m+1]. All the ensembles are evaluated
+    together on a batch of capacity vectors by descending every (row, tree)
+    pair one level per step, with child positions computed arithmetically.
+    """
+
+    # pure NumPy on read-only arrays, safe to call from several threads
+    thread_safe = True
+
+    def __init__(self, feature, threshold, default_left, value, tree_offsets, base_score,
+                 chunk_size=256):
+        self.feature = feature
+        self.threshold = threshold
+        self.default_left = default_left
+        self.value = value
+        self.tree_offsets = tree_offsets
+        self.base_score = base_score
+        self.max_depth = int(np.log2(value.shape[1]))
+        self.chunk_size = chunk_size
+
+    @classmethod
+    def from_models(cls, models):
+        trees, offsets, base_score = [], [0], []
+        for model in models:
+            doc = _booster_json(model.get_booster())
+            learner = doc["learner"]
+            base_score.append(float(str(learner["learner_model_param"]["base_score"]).strip("[]")))
+            model_trees = learner["gradient_booster"]["model"]["trees"]
+            limit = _num_trees(model)
+            if limit is not None:
+                model_trees = model_trees[:limit]
+            trees.extend(model_trees)
+            offsets.append(len(trees))
+
+        depth = max(_tree_depth(t["left_children"], t["right_children"]) for t in trees)
+        feature = np.zeros((len(trees), 2**depth - 1), dtype=np.intp)
+        threshold = np.zeros((len(trees), 2**depth - 1), dtype=np.float32)
+        default_left = np.zeros((len(trees), 2**depth - 1), dtype=bool)
+        value = np.zeros((len(trees), 2**depth), dtype=np.float32)
+        for t, tree in enumerate(trees):
+            _fill_complete(tree, depth, feature[t], threshold[t], default_left[t], value[t])
+        return cls(feature, threshold, default_left, value,
+                   np.asarray(offsets, dtype=np.intp), np.asarray(base_score))
+
+    def __len__(self):
+        return len(self.tree_offsets) - 1
+
+    def __reduce_ex__(self, protocol):
+        # loaded from a model bank: pickle as a reference to it
+        if getattr(self, "source", None) is not None:
+            from approximate_equilibrium import modelbank
+            return modelbank._bank_models, self.source
+        return super(CompiledTreeEnsemble, self).__reduce_ex__(protocol)
+
+    def _leaf_values(self, X):
+        n_rows, n_features = X.shape
+        n_trees, n_internal = self.feature.shape
+        feature, threshold = self.feature.ravel(), self.threshold.ravel()
+        default_left = self.default_left.ravel()
+        tree_base = (np.arange(n_trees, dtype=np.intp) * n_internal)[None, :]
+        row = (np.arange(n_rows, dtype=np.intp) * n_features)[:, None]
+        Xf = X.ravel()
+
+        node = np.zeros((n_rows, n_trees), dtype=np.intp)
+        for _ in range(self.max_depth):
+            pos = tree_base + node
+            xv = Xf.take(row + feature.take(pos))
+            go_left = xv < threshold.take(pos)
+            missing = np.isnan(xv)
+            if missing.any():
+                go_left = np.where(missing, default_left.take(pos), go_left)
+            node = 2*node + 2 - go_left
+        leaf = node - n_internal + (np.arange(n_trees, dtype=np.intp) * self.value.shape[1])[None, :]
+        return self.value.ravel().take(leaf)
+
+    def subset(self, columns):
+        """Ensemble of the models in `columns` only, in that order (memoized)"""
+        key = tuple(int(c) for c in columns)
+        subsets = self.__dict__.setdefault("_subsets", {})
+        if key not in subsets:
+            rows = np.concatenate([np.arange(self.tree_offsets[c], self.tree_offsets[c + 1]) for c in key])
+            sizes = np.diff(self.tree_offsets)[list(key)]
+            subsets[key] = CompiledTreeEnsemble(self.feature[rows], self.threshold[rows],
+                                                self.default_left[rows], self.value[rows],
+                                                np.concatenate([[0], np.cumsum(sizes)]).astype(np.intp),
+                                                self.base_score[list(key)], self.chunk_size)
+        return subsets[key]
+
+    def predict_all(self, X, columns=None):
+        """
+        Predictions of every model (or of the models in `columns`, in that
+        order) for each row of X, shape (N, num_models)
+        """
+        if columns is not None:
+            return self.subset(columns).predict_all(X)
+        X = np.atleast_2d(np.asarray(X, dtype=np.float32))
+        out = np.empty((X.shape[0], len(self)))
+        for start in range(0, X.shape[0], self.chunk_size):
+            vals = self._leaf_values(X[start:start + self.chunk_size])
+            out[start:start + self.chunk_size] = np.add.reduceat(vals, self.tree_offsets[:-1],
+                                                                 axis=1, dtype=float)
+        return out + self.base_score
+
+
+def benchmark_predict(models, X, rows=(1, 100, 1000), repeat=20):
+    """
+    Latency of predicting every technology with XGBRegressor.predict (one
+    call per model) and with CompiledTreeEnsemble.predict_all (one call) on
+    the first `rows` rows of X, along with the largest prediction difference
+    """
+    compiled = CompiledTreeEnsemble.from_models(models)
+    results = []
+    for n in rows:
+        Xn = np.asarray(X)[:n]
+        tic = time.perf_counter()
+        for _ in range(repeat):
+            ref = np.column_stack([m.predict(Xn) for m in models])
+        xgb_s = (time.perf_counter() - tic) / repeat
+        tic = time.perf_counter()
+        for _ in range(repeat):
+            pred = compiled.predict_all(Xn)
+        compiled_s = (time.perf_counter() - tic) / repeat
+        results.append({"rows": len(Xn), "xgboost_s": xgb_s, "compiled_s": compiled_s,
+                        "speedup": xgb_s / compiled_s, "max_abs_err": float(np.abs(ref - pred).max())})
+    return results
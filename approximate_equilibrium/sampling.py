@@ -0,0 +1,185 @@
+import os
+
+import numpy as np
+
+
+# Julia template of src/sampling/generate_continuous_config.jl, read by export_configurations
+TEMPLATE_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             "src", "sampling", "generate_continuous_config.jl")
+
+# keys of ContinuousBuildContainer (src/devices/continous_devices.jl), the only
+# technologies a generated configuration can add
+PRIME_MOVERS = ("CT", "CC", "ST", "WT", "PVe", "BA", "HY")
+
+
+def solver_trajectory(solver):
+    """
+    Total capacity x_tot after every recorded round of a DiagonalizedSolver,
+    shape (num_rounds, num_gens), from its agents' decision history; the
+    last row is the final X
+    """
+    decisions = [np.reshape(d, (-1, solver.num_gens)) for d in solver.get_agent_decisions().values()]
+    rounds = min(len(d) for d in decisions)
+    totals = sum(d[:rounds] for d in decisions)
+    return np.vstack([totals, solver.X.sum(axis=0)])
+
+
+def distance_uncertainty(capacity):
+    """
+    Uncertainty proxy: distance of each point to the nearest existing
+    sample, with every technology scaled by its sampled range
+    """
+    capacity = np.asarray(capacity, dtype=float)
+    scale = np.ptp(capacity, axis=0)
+    scale[scale == 0] = 1.
+    samples = capacity / scale
+
+    def uncertainty(X):
+        X = np.atleast_2d(X) / scale
+        out = np.empty(len(X))
+        for start in range(0, len(X), 256):
+            d = ((X[start:start + 256, None, :] - samples[None, :, :])**2).sum(axis=2)
+            out[start:start + 256] = np.sqrt(d.min(axis=1))
+        return out
+
+    return uncertainty
+
+
+def ensemble_uncertainty(model_sets):
+    """
+    Uncertainty as the spread (standard deviation) of the total predicted
+    revenue across model sets trained on different data, e.g. fit_models
+    with different random_state or on bootstrap resamples
+    """
+    def predict_total(models, X):
+        if hasattr(models, "predict_all"):
+            return models.predict_all(X).sum(axis=1)
+        return sum(np.asarray(models[ix].predict(X)).reshape(-1) for ix in range(len(models)))
+
+    def uncertainty(X):
+        X = np.atleast_2d(X)
+        return np.std([predict_total(models, X) for models in model_sets], axis=0)
+
+    return uncertainty
+
+
+def propose_samples(trajectory, capacity, num_samples=10, uncertainty=None, radius=0.1,
+                    candidates=2000, equilibrium_weight=4., lower=None, upper=None, seed=None):
+    """
+    Capacity configurations worth simulating next, shape (num_samples,
+    num_gens). Candidates are drawn around the points of `trajectory` (see
+    solver_trajectory) with a spread of radius times each technology's
+    range: later rounds get more candidates and the final point
+    equilibrium_weight times as many. Each candidate is scored by
+    `uncertainty` (a callable on an (N, num_gens) array, distance to the
+    existing samples `capacity` by default), down-weighted by its distance
+    from the trajectory point it was drawn around, and the batch is picked
+    greedily, discounting candidates close to those already picked so
+    that the proposals are spread out. lower and upper default to the
+    range of the existing samples.
+    """
+    rng = np.random.RandomState(seed)
+    trajectory = np.atleast_2d(np.asarray(trajectory, dtype=float))
+    capacity = np.asarray(capacity, dtype=float)
+    lower = capacity.min(axis=0) if lower is None else np.asarray(lower, dtype=float)
+    upper = capacity.max(axis=0) if upper is None else np.asarray(upper, dtype=float)
+    span = np.maximum(upper - lower, np.finfo(float).eps)
+    if uncertainty is None:
+        uncertainty = distance_uncertainty(capacity)
+
+    weights = np.arange(1., len(trajectory) + 1.)
+    weights[-1] *= equilibrium_weight
+    counts = rng.multinomial(candidates, weights / weights.sum())
+    centres = np.repeat(trajectory, counts, axis=0)
+    cand = np.clip(centres + rng.randn(*centres.shape) * radius * span, lower, upper)
+    score = np.asarray(uncertainty(cand), dtype=float)
+    score = score - score.min() + np.finfo(float).eps
+    # keep the batch close to the trajectory rather than in the tails of the draws
+    score *= np.exp(-(((cand - centres) / span)**2).sum(axis=1) / (2. * radius**2))
+
+    chosen = []
+    discount = np.ones(len(cand))
+    for _ in range(min(num_samples, len(cand))):
+        k = int(np.argmax(score * discount))
+        chosen.append(k)
+        d2 = (((cand - cand[k]) / span)**2).sum(axis=1)
+        discount *= 1. - np.exp(-d2 / (2. * radius**2))
+    return cand[chosen]
+
+
+def _render(template, devices, config):
+    """Fill the {{#types}} section of the configuration template with one line per technology"""
+    start, end = template.index("{{#types}}"), template.index("{{/types}}")
+    line = template[start + len("{{#types}}"):end].strip("\n")
+    lines = [line.replace("{{type}}", str(d)).replace("{{{config}}}", repr(float(v)))
+             for d, v in zip(devices, config)]
+    return template[:start] + "\n".join(lines) + template[end + len("{{/types}}"):]
+
+
+def _prime_movers(devices):
+    """
+    Prime mover of each device: the device itself, or its category for the
+    Category_Bus columns of regional data. Raises ValueError otherwise.
+    """
+    movers = []
+    for d in devices:
+        mover = d if str(d) in PRIME_MOVERS else str(d).split("_", 1)[0]
+        if mover not in PRIME_MOVERS:
+            raise ValueError("Device {} is not a prime mover of a continuous build "
+                             "configuration (one of {}, optionally followed by _<bus>)".format(
+                                 d, ", ".join(PRIME_MOVERS)))
+        movers.append(mover)
+    return movers
+
+
+def read_template(template_file=TEMPLATE_FILE):
+    """The Mustache template string of a Julia configuration generator"""
+    with open(template_file) as f:
+        source = f.read()
+    start = source.index('template = """') + len('template = """')
+    return source[start:source.index('"""', start)]
+
+
+def export_configurations(directory, configs, devices, start_id=1, scale=1.,
+                          template_file=TEMPLATE_FILE):
+    """
+    Write each configuration as sample_configuration_<id>.jl in directory,
+    in the layout produced by generate_continuos_configuration (one
+    devices_added[PSY.PrimeMovers.<device>] entry per technology), with
+    capacities divided by scale to convert them to the configuration's
+    units. Regional Category_Bus devices are summed per category, as the
+    configuration only sets a total per prime mover. A proposals.csv lists
+    the ids and the capacities per device. Returns the ids.
+    """
+    import pandas as pd
+    movers = _prime_movers(devices)
+    technologies = list(dict.fromkeys(movers))
+    template = read_template(template_file)
+    os.makedirs(directory, exist_ok=True)
+    configs = np.atleast_2d(configs) / scale
+    totals = np.stack([configs[:, [m == t for m in movers]].sum(axis=1) for t in technologies],
+                      axis=1)
+    ids = list(range(start_id, start_id + len(configs)))
+    for id, config in zip(ids, totals):
+        filename = os.path.join(directory, "sample_configuration_{}.jl".format(id))
+        with open(filename, "w") as f:
+            f.write(_render(template, technologies, config))
+    pd.DataFrame(configs, index=pd.Index(ids, name="id"), columns=list(devices)).to_csv(
+        os.path.join(directory, "proposals.csv"))
+    return ids
+
+
+def propose_from_solver(solver, D, directory, num_samples=10, uncertainty=None, start_id=1,
+                        scale=1., **options):
+    """
+    propose_samples around the trajectory of a DiagonalizedSolver run,
+    relative to the samples in D.capacity, exported to directory with
+    export_configurations. Simulating the proposals and retraining is left
+    to the caller: once they are read into D (e.g. with
+    DataAggregator.refresh), model.fit_models with previous=<current
+    models> continues boosting on them instead of starting from scratch.
+    """
+    configs = propose_samples(solver_trajectory(solver), D.capacity.values, num_samples,
+                              uncertainty, **options)
+    export_configurations(directory, configs, D.devices, start_id, scale)
+    return configs
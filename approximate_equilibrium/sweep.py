@@ -0,0 +1,232 @@
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+import numpy as np
+
+from approximate_equilibrium.diagonalization import DiagonalizedSolver
+
+
+logger = logging.getLogger(__name__)
+
+# Models and base inputs of the running sweep: set in this process, and in
+# each worker by _init_sweep (or inherited when the pool is forked), so a
+# worker receives them once rather than with every scenario
+_SWEEP = {}
+
+
+def _init_sweep(state):
+    """Pool initializer: the state is sent to each worker once"""
+    _SWEEP.update(state)
+
+
+class AdjustedModels(object):
+    """
+    Model set predicting the revenue net of capex and with capacity market
+    revenue, as DataAggregator.subtract_capex_cost and
+    add_capacity_market_rev do to the training data: technology d predicts
+    pred_d(x_tot) - x_tot[d] * capex[d] + cap_mrkt[d]. capex and cap_mrkt
+    are sequences over the technologies (zero when None).
+    """
+
+    def __init__(self, models, capex=None, cap_mrkt=None):
+        self.models = models
+        n = len(models)
+        self.capex = np.zeros(n) if capex is None else np.asarray(capex, dtype=float)
+        self.cap_mrkt = np.zeros(n) if cap_mrkt is None else np.asarray(cap_mrkt, dtype=float)
+
+    def __len__(self):
+        return len(self.models)
+
+    def __getitem__(self, ix):
+        return _AdjustedModel(self, ix)
+
+    @property
+    def thread_safe(self):
+        return getattr(self.models, "thread_safe", False)
+
+    def predict_all(self, x_tot, columns=None):
+        """
+        Adjusted predictions of every technology (or of those in `columns`)
+        for each row of x_tot, shape (N, num_models)
+        """
+        x_tot = np.atleast_2d(np.asarray(x_tot, dtype=float))
+        cols = np.arange(len(self)) if columns is None else np.asarray(columns)
+        if hasattr(self.models, "predict_all"):
+            if columns is None:
+                pred = np.asarray(self.models.predict_all(x_tot), dtype=float)
+            else:
+                pred = np.asarray(self.models.predict_all(x_tot, columns=columns), dtype=float)
+        else:
+            pred = np.column_stack([np.asarray(self.models[ix].predict(x_tot)).reshape(-1)
+                                    for ix in cols])
+        return pred - x_tot[:, cols] * self.capex[cols] + self.cap_mrkt[cols]
+
+
+class _AdjustedModel(object):
+
+    def __init__(self, adjusted, ix):
+        self.adjusted = adjusted
+        self.ix = ix
+
+    def predict(self, x_tot):
+        x_tot = np.atleast_2d(np.asarray(x_tot, dtype=float))
+        pred = np.asarray(self.adjusted.models[self.ix].predict(x_tot), dtype=float).reshape(-1)
+        return pred - x_tot[:, self.ix] * self.adjusted.capex[self.ix] + self.adjusted.cap_mrkt[self.ix]
+
+
+def _broadcast(value, base):
+    """A scenario's capcosts / caplimits: the base array, or a value broadcast to its shape"""
+    if value is None:
+        return base
+    return np.broadcast_to(np.asarray(value, dtype=float), base.shape).copy()
+
+
+def _get(scenario, key, default=None):
+    """scenario[key], or default when it is missing or NaN (an empty DataFrame cell)"""
+    value = scenario.get(key)
+    if value is None or (np.isscalar(value) and isinstance(value, float) and np.isnan(value)):
+        return default
+    return value
+
+
+def _run_scenario(scenario):
+    """Solve one scenario with the models and base inputs in _SWEEP, returning its result record"""
+    tic = time.time()
+    name = scenario["scenario"]
+    try:
+        models = _SWEEP["models"]
+        capex, cap_mrkt = _get(scenario, "capex"), _get(scenario, "cap_mrkt")
+        if capex is not None or cap_mrkt is not None:
+            models = AdjustedModels(models, capex, cap_mrkt)
+        seed = _get(scenario, "seed")
+        solver = DiagonalizedSolver(_broadcast(_get(scenario, "capcosts"), _SWEEP["capcosts"]),
+                                    _broadcast(_get(scenario, "caplimits"), _SWEEP["caplimits"]),
+                                    _SWEEP["nodes"], models, _SWEEP["model_names"], _SWEEP["datastruct"],
+                                    action_increment=_get(scenario, "action_increment", np.inf),
+                                    seed=None if seed is None else int(seed), n_jobs=1)
+        for setter, kwargs in _SWEEP["solver_options"].items():
+            getattr(solver, setter)(**kwargs)
+        rounds = solver.iterate(int(_get(scenario, "num_steps", _SWEEP["num_steps"])))
+        return {"scenario": name, "X": solver.X.tolist(),
+                "f": [float(solver.agents[i]["f"][-1]) for i in range(solver.num_agents)],
+                "rounds": rounds, "stop_reason": solver.stop_reason,
+                "residual": solver.residuals[-1] if solver.residuals else None,
+                "seconds": time.time() - tic}
+    except Exception as e:
+        return {"scenario": name, "error": repr(e), "seconds": time.time() - tic}
+
+
+def finished_scenarios(results_file):
+    """Names of the scenarios with a result (not an error) in results_file"""
+    done = set()
+    if not os.path.exists(results_file):
+        return done
+    with open(results_file) as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                # a line cut short by an interrupted sweep
+                continue
+            if "error" not in rec:
+                done.add(rec["scenario"])
+    return done
+
+
+class ScenarioSweep(object):
+    """
+    Runs DiagonalizedSolver over a table of scenarios on n_jobs worker
+    processes. Each scenario is a dict (or a DataFrame row) with a unique
+    "scenario" name and optionally "capcosts" and "caplimits" (replacing
+    the base arrays, scalars are broadcast), "action_increment", "capex"
+    and "cap_mrkt" (see AdjustedModels), "num_steps" and "seed".
+    solver_options maps DiagonalizedSolver setters to their keyword
+    arguments, e.g. {"set_convergence_criteria": {"x_tol": 1.}}. The
+    scenarios already run in parallel, so each solver is single-process:
+    options asking for worker processes are rejected (restart threads,
+    set_restart_options, are allowed).
+
+    The surrogate models are loaded once by the caller and sent to each
+    worker once. The workers are started with start_method, by default
+    "forkserver" (or "spawn" where unavailable): forking a parent that has
+    already run XGBoost's OpenMP threads can deadlock the workers, so
+    "fork" (which shares the models copy-on-write) is only safe before
+    any model has been used. Models loaded from a ModelBank with
+    backend="compiled" (or an ICNN bank) are sent as a reference to the
+    bank and memory-mapped by every worker. At most
+    max_pending scenarios are queued at a time, and each result is
+    appended to results_file as a JSON line as soon as it is done;
+    scenarios already in the file are skipped.
+    """
+
+    def __init__(self, models, model_names, datastruct, nodes, capcosts, caplimits, results_file,
+                 num_steps=10, n_jobs=1, max_pending=None, solver_options=None, start_method=None):
+        self.models = models
+        self.model_names = model_names
+        self.datastruct = datastruct
+        self.nodes = nodes
+        self.capcosts = np.asarray(capcosts, dtype=float)
+        self.caplimits = np.asarray(caplimits, dtype=float)
+        self.results_file = results_file
+        self.num_steps = num_steps
+        self.n_jobs = n_jobs
+        self.max_pending = max_pending or 2 * n_jobs
+        self.solver_options = solver_options or {}
+        for setter, kwargs in self.solver_options.items():
+            if setter != "set_restart_options" and kwargs.get("n_jobs", 1) > 1:
+                raise ValueError("solver_options[{!r}]: sweep workers cannot start worker pools "
+                                 "(n_jobs={})".format(setter, kwargs["n_jobs"]))
+        methods = multiprocessing.get_all_start_methods()
+        self.start_method = start_method or ("forkserver" if "forkserver" in methods else "spawn")
+        self._lock = threading.Lock()
+
+    def _write(self, rec):
+        with self._lock:
+            with open(self.results_file, "a") as f:
+                f.write(json.dumps(rec) + "\n")
+                f.flush()
+        if "error" in rec:
+            logger.warning("scenario %s failed: %s", rec["scenario"], rec["error"])
+        else:
+            logger.info("scenario %s: %d rounds, %1.0fs", rec["scenario"], rec["rounds"], rec["seconds"])
+
+    def run(self, scenarios):
+        """Solve every scenario not yet in results_file; returns the number solved"""
+        if hasattr(scenarios, "to_dict"):
+            scenarios = scenarios.to_dict("records")
+        done = finished_scenarios(self.results_file)
+        todo = [s for s in scenarios if s["scenario"] not in done]
+        logger.info("%d scenarios, %d already finished", len(scenarios), len(scenarios) - len(todo))
+
+        _SWEEP.update(models=self.models, model_names=self.model_names, datastruct=self.datastruct,
+                      nodes=self.nodes, capcosts=self.capcosts, caplimits=self.caplimits,
+                      num_steps=self.num_steps, solver_options=self.solver_options)
+        if self.n_jobs <= 1:
+            for s in todo:
+                self._write(_run_scenario(s))
+            return len(todo)
+
+        slots = threading.BoundedSemaphore(self.max_pending)
+
+        def finish(rec):
+            self._write(rec)
+            slots.release()
+
+        context = multiprocessing.get_context(self.start_method)
+        if self.start_method == "fork":
+            pool = context.Pool(self.n_jobs)
+        else:
+            pool = context.Pool(self.n_jobs, initializer=_init_sweep, initargs=(dict(_SWEEP),))
+        with pool:
+            for s in todo:
+                slots.acquire()
+                pool.apply_async(_run_scenario, (s,), callback=finish,
+                                 error_callback=lambda e, name=s["scenario"]: finish(
+                                     {"scenario": name, "error": repr(e)}))
+            pool.close()
+            pool.join()
+        return len(todo)
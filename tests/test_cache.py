@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from approximate_equilibrium.optimize import (CompiledTreeEnsemble, NumpyICNN, NumpyICNNEvaluator,
+                                              PredictionCache)
+
+
+def _xgb_models(num_gens=4):
+    pytest.importorskip("xgboost")
+    from approximate_equilibrium.benchmarks import train_xgboost
+    rng = np.random.RandomState(0)
+    capacity = rng.rand(200, num_gens) * 100
+    revenue = np.column_stack([200 * capacity[:, k] - 0.5 * capacity[:, k] * capacity.sum(axis=1)
+                               for k in range(num_gens)])
+    return train_xgboost(capacity, revenue, n_estimators=10)
+
+
+def _icnn_nets(num_gens=4):
+    rng = np.random.RandomState(0)
+    nets = []
+    for output_dim in (1, 3):
+        nets.append(NumpyICNN([rng.rand(num_gens, 8), rng.rand(8, 8)],
+                              [(rng.randn(num_gens, 8), rng.randn(8))],
+                              rng.rand(8, output_dim)))
+    return nets
+
+
+def _model_sets():
+    models = _xgb_models()
+    nets = _icnn_nets()
+    return {"list": models,
+            "compiled": CompiledTreeEnsemble.from_models(models),
+            "numpy_icnn": NumpyICNNEvaluator(nets)}
+
+
+def _reference(models, X):
+    if hasattr(models, "predict_all"):
+        return models.predict_all(X)
+    return np.column_stack([m.predict(X) for m in models])
+
+
+@pytest.mark.parametrize("kind", ["list", "compiled", "numpy_icnn"])
+def test_cache_matches_models(kind):
+    models = _model_sets()[kind]
+    cache = PredictionCache(models, resolution=1.)
+    X = np.round(np.random.RandomState(1).rand(20, 4) * 80)
+    ref = _reference(models, X)
+
+    np.testing.assert_allclose(cache.predict_all(X), ref, rtol=1e-5)
+    assert cache.stats() == {"hits": 0, "misses": 20, "size": 20}
+    np.testing.assert_allclose(cache.predict_all(X), ref, rtol=1e-5)
+    assert cache.stats()["hits"] == 20
+
+    columns = [2, 0]
+    np.testing.assert_allclose(cache.predict_all(X, columns=columns), ref[:, columns], rtol=1e-5)
+    assert cache.stats()["size"] == 40
+
+
+def test_cache_quantizes_before_predicting():
+    models = _model_sets()["compiled"]
+    cache = PredictionCache(models, resolution=5.)
+    X = np.random.RandomState(2).rand(10, 4) * 80
+    np.testing.assert_allclose(cache.predict_all(X), models.predict_all(np.round(X / 5.) * 5.),
+                               rtol=1e-5)
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from approximate_equilibrium.optimize import NumpyICNN, NumpyICNNEvaluator
+
+
+def _random_net(input_dim, output_dim, seed, output_activation="relu"):
+    rng = np.random.RandomState(seed)
+    W = [rng.rand(input_dim, 8), rng.rand(8, 8), rng.rand(8, 8)]
+    D = [(rng.randn(input_dim, 8), rng.randn(8)) for _ in range(2)]
+    return NumpyICNN(W, D, rng.rand(8, output_dim), output_activation=output_activation)
+
+
+def _finite_difference(net, u, eps=1e-6):
+    jac = np.empty((net.output_dim, u.size))
+    for k in range(u.size):
+        step = np.zeros_like(u)
+        step[k] = eps
+        jac[:, k] = (net.predict(u + step)[0] - net.predict(u - step)[0]) / (2 * eps)
+    return jac
+
+
+@pytest.mark.parametrize("output_dim", [1, 3])
+@pytest.mark.parametrize("output_activation", ["relu", "linear"])
+def test_gradient_matches_finite_differences(output_dim, output_activation):
+    net = _random_net(4, output_dim, seed=output_dim, output_activation=output_activation)
+    U = np.random.RandomState(0).rand(5, 4)
+    y, jac = net.value_and_gradient(U)
+    assert y.shape == (5, output_dim) and jac.shape == (5, output_dim, 4)
+    np.testing.assert_allclose(y, net.predict(U))
+    for n, u in enumerate(U):
+        np.testing.assert_allclose(jac[n], _finite_difference(net, u), rtol=1e-5, atol=1e-6)
+
+
+def test_evaluator_stacks_outputs():
+    nets = [_random_net(4, 1, seed=0), _random_net(4, 3, seed=1)]
+    ev = NumpyICNNEvaluator(nets)
+    u = np.random.RandomState(1).rand(4)
+    y, grad = ev.evaluate(u)
+    assert len(ev) == 4 and y.shape == (4,) and grad.shape == (4, 4)
+    np.testing.assert_allclose(y, np.concatenate([net.predict(u)[0] for net in nets]))
+    np.testing.assert_allclose(ev.predict_all(u[None, :]), y[None, :])
+
+
+@pytest.mark.parametrize("output_dim", [1, 3])
+def test_parity_with_keras(output_dim):
+    pytest.importorskip("keras")
+    from approximate_equilibrium.model_icnn import icnn_model
+    from approximate_equilibrium.optimize.icnn import clear_evaluators, icnn_parity
+
+    model = icnn_model(4, output_dim, num_layers=2, num_units=8)
+    rng = np.random.RandomState(output_dim)
+    # weights away from the near-zero initialization, non-negative where constrained
+    model.set_weights([np.abs(w) if "W_" in layer_name or layer_name == "output" else w
+                       for layer_name, w in _named_weights(model, rng)])
+    U = rng.rand(6, 4)
+
+    net = NumpyICNN.from_keras(model)
+    np.testing.assert_allclose(net.predict(U), model.predict(U), rtol=1e-4, atol=1e-4)
+    clear_evaluators()
+    errors = icnn_parity([model], U)
+    assert errors["prediction"] < 1e-4
+    assert errors["gradient"] < 1e-4
+
+
+def _named_weights(model, rng):
+    for layer in model.layers:
+        for w in layer.get_weights():
+            yield layer.name, rng.randn(*w.shape)